@@ -0,0 +1,55 @@
+import os
+import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+def targets(z):
+    """(member, relative destination path) of the files in an archive. If all files
+    are in a single top level folder, they are extracted without it."""
+    files = [i for i in z.infolist() if not i.is_dir()]
+    tops = set([i.filename.split("/", 1)[0] for i in files])
+    strip = len(tops) == 1 and all("/" in i.filename for i in files)
+    out = []
+    for i in files:
+        name = i.filename.split("/", 1)[1] if strip else i.filename
+        out.append((i, name))
+    return out
+
+def is_extracted(archive, dest):
+    """Whether every file of archive is in dest with the right size"""
+    with zipfile.ZipFile(archive, "r") as z:
+        for info, name in targets(z):
+            path = os.path.join(dest, name)
+            if not os.path.isfile(path) or os.path.getsize(path) != info.file_size:
+                return False
+    return True
+
+def _extract_member(archive, info, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Each thread has its own handle, so that members are decompressed in parallel
+    with zipfile.ZipFile(archive, "r") as z, \
+         z.open(info, "r") as src, \
+         open(path + ".tmp", "wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(path + ".tmp", path)
+
+def extract(archive, dest, max_workers=None):
+    """Extract all files of archive into dest, one thread per member.
+    The archive is kept, so that is_extracted can validate dest later on."""
+    with zipfile.ZipFile(archive, "r") as z:
+        members = targets(z)
+
+    dest = os.path.abspath(dest)
+    os.makedirs(dest, exist_ok=True)
+    jobs = []
+    for info, name in members:
+        path = os.path.abspath(os.path.join(dest, name))
+        if not path.startswith(dest + os.sep):
+            raise Exception(f"Invalid path in {archive}: {info.filename}")
+        jobs.append((info, path))
+
+    # Largest members first
+    jobs.sort(key=lambda j: -j[0].file_size)
+    with ThreadPoolExecutor(max_workers=max_workers or min(32, (os.cpu_count() or 1) + 4)) as executor:
+        for _ in executor.map(lambda j: _extract_member(archive, *j), jobs):
+            pass
@@ -0,0 +1,180 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import ctranslate2
+import archives
+from lineindex import LineIndex
+from readers import count_lines
+from benchmark import detokenize
+from tokenizer import SentencePieceTokenizer, BPETokenizer
+
+def fingerprint(file):
+    st = os.stat(file)
+    return [os.path.abspath(file), st.st_size, st.st_mtime_ns]
+
+def load_package(package_file, cache_dir):
+    """Extract an .argosmodel to cache_dir (once). Returns (CTranslate2 model dir, tokenizer)"""
+    key = hashlib.md5(json.dumps(fingerprint(package_file)).encode('utf-8')).hexdigest()
+    package_dir = os.path.join(cache_dir, "packages", key)
+    if not os.path.isdir(package_dir) or not archives.is_extracted(package_file, package_dir):
+        print(f"Extracting {package_file} to {package_dir}")
+        archives.extract(package_file, package_dir)
+
+    with open(os.path.join(package_dir, "metadata.json"), "r", encoding="utf-8") as f:
+        metadata = json.loads(f.read())
+    sp_model = os.path.join(package_dir, "sentencepiece.model")
+    if os.path.isfile(sp_model):
+        tokenizer = SentencePieceTokenizer(sp_model)
+    else:
+        tokenizer = BPETokenizer(os.path.join(package_dir, "bpe.model"), metadata['from_code'], metadata['to_code'])
+    return os.path.join(package_dir, "model"), tokenizer
+
+def completed_lines(shard_file):
+    """Number of lines already written to shard_file. A partially written last line is removed."""
+    if not os.path.isfile(shard_file):
+        return 0
+    with open(shard_file, "r+b") as f:
+        pos = f.seek(0, os.SEEK_END)
+        while pos > 0:
+            step = min(pos, 1024 * 1024)
+            f.seek(pos - step)
+            i = f.read(step).rfind(b"\n")
+            if i != -1:
+                pos = pos - step + i + 1
+                break
+            pos -= step
+        f.truncate(pos)
+    return count_lines(shard_file)
+
+def translate_shard(package_file, cache_dir, input_file, shard_file, first, last, device, device_index, threads,
+                    beam_size, max_batch_size, chunk_size):
+    model_dir, tokenizer = load_package(package_file, cache_dir)
+    translator = ctranslate2.Translator(model_dir, device=device, device_index=device_index, compute_type="default",
+                                       inter_threads=1, intra_threads=threads)
+    total = last - first
+    done = completed_lines(shard_file)
+    index = LineIndex(input_file, os.path.join(cache_dir, "index"))
+
+    def encode(chunk):
+        if chunk is None:
+            return None
+        tokens = tokenizer.encode_batch(chunk, num_threads=threads)
+        # Sentences of similar length are translated together, with less padding
+        order = sorted(range(len(tokens)), key=lambda i: len(tokens[i]))
+        return order, [tokens[i] for i in order]
+
+    with open(input_file, "rb") as f, \
+         open(shard_file, "ab") as out, \
+         ThreadPoolExecutor(max_workers=1) as encoder:
+        f.seek(index.offset(first + done))
+        lines = itertools.islice(f, total - done)
+        chunks = iter(lambda: [l.decode("utf-8").rstrip("\n") for l in itertools.islice(lines, chunk_size)], [])
+
+        # The next chunk is tokenized while the current one is translated
+        next_chunk = encoder.submit(encode, next(chunks, None))
+        while True:
+            encoded = next_chunk.result()
+            if encoded is None:
+                break
+            next_chunk = encoder.submit(encode, next(chunks, None))
+
+            order, tokens = encoded
+            results = translator.translate_batch(tokens, beam_size=beam_size, max_batch_size=max_batch_size, return_scores=False)
+            translated = [None] * len(order)
+            for i, r in zip(order, results):
+                translated[i] = detokenize(r.hypotheses[0], tokenizer).replace("\n", " ")
+
+            # Whole chunks are written, so that a resumed run can count the lines done
+            out.write(("\n".join(translated) + "\n").encode("utf-8"))
+            out.flush()
+            done += len(order)
+            print(f"{os.path.basename(shard_file)}: {done}/{total}")
+    return done
+
+def batch_translate(package_file, input_file, output_file, processes=None, beam_size=4, max_batch_size=32, chunk_size=10000):
+    """Translate input_file line by line with an .argosmodel into output_file.
+    Contiguous shards of lines are translated by separate processes (one per GPU, or
+    sharing the CPU cores). Shards are kept until all are complete, so an interrupted
+    run resumes where it stopped."""
+    cache_dir = os.path.join(os.path.dirname(__file__), "cache")
+    load_package(package_file, cache_dir)
+
+    gpus = ctranslate2.get_cuda_device_count()
+    device = "cuda" if gpus > 0 else "cpu"
+    processes = processes or (gpus if gpus > 0 else max(1, (os.cpu_count() or 1) // 4))
+    threads = 1 if device == "cuda" else max(1, (os.cpu_count() or 1) // processes)
+    total = len(LineIndex(input_file, os.path.join(cache_dir, "index")))
+
+    # Shards of a different input, model or settings can't be resumed
+    shard_dir = output_file + ".shards"
+    state = {'package': fingerprint(package_file), 'input': fingerprint(input_file), 'processes': processes,
+             'beam_size': beam_size}
+    state_file = os.path.join(shard_dir, "state.json")
+    if os.path.isdir(shard_dir):
+        previous = None
+        if os.path.isfile(state_file):
+            with open(state_file, "r", encoding="utf-8") as f:
+                previous = json.loads(f.read())
+        if previous != state:
+            shutil.rmtree(shard_dir)
+        else:
+            print(f"Resuming from {shard_dir}")
+    os.makedirs(shard_dir, exist_ok=True)
+    with open(state_file, "w", encoding="utf-8") as f:
+        f.write(json.dumps(state))
+
+    bounds = [total * i // processes for i in range(processes + 1)]
+    shard_files = [os.path.join(shard_dir, f"shard-{i}.txt") for i in range(processes)]
+    print(f"Translating {total} lines with {processes} process(es) on {device}")
+
+    # CUDA and CTranslate2's thread pools don't survive a fork
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(translate_shard, package_file, cache_dir, input_file, shard_files[i],
+                                   bounds[i], bounds[i + 1], device, i % gpus if gpus > 0 else 0, threads,
+                                   beam_size, max_batch_size, chunk_size) for i in range(processes)]
+        for f in futures:
+            f.result()
+
+    with open(output_file + ".tmp", "wb") as out:
+        for shard_file in shard_files:
+            with open(shard_file, "rb") as f:
+                shutil.copyfileobj(f, out, 1024 * 1024)
+    os.replace(output_file + ".tmp", output_file)
+    shutil.rmtree(shard_dir)
+    return total
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Translate a text file with an .argosmodel, one sentence per line')
+    parser.add_argument('--model',
+        type=str,
+        required=True,
+        help='Path to the .argosmodel. Default: %(default)s')
+    parser.add_argument('--input',
+        type=str,
+        required=True,
+        help='Text file to translate. Default: %(default)s')
+    parser.add_argument('--output',
+        type=str,
+        required=True,
+        help='Output file. Default: %(default)s')
+    parser.add_argument('--processes',
+        type=int,
+        default=None,
+        help='Number of shards translated in parallel. Default: one per GPU, or one per 4 CPU cores')
+    parser.add_argument('--beam-size',
+        type=int,
+        default=4,
+        help='Beam size. Default: %(default)s')
+    parser.add_argument('--max-batch-size',
+        type=int,
+        default=32,
+        help='Max batch size for translation. Default: %(default)s')
+    args = parser.parse_args()
+
+    batch_translate(args.model, args.input, args.output, processes=args.processes,
+                    beam_size=args.beam_size, max_batch_size=args.max_batch_size)
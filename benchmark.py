@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import itertools
+import subprocess
+import tempfile
+import ctranslate2
+from concurrent.futures import ThreadPoolExecutor
+from sacrebleu import corpus_bleu
+
+def model_size(model_dir):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(model_dir) for f in files)
+
+def detokenize(tokens, tokenizer):
+    text = tokenizer.decode(tokens)
+    if len(text) > 0 and text[0] == " ":
+        text = text[1:]
+    return text
+
+def benchmark(model_dir, tokenizer, src_text, tgt_text, device="cpu", beam_size=4, max_batch_size=16, use_vmap=False):
+    """Load time, translation speed, disk size and BLEU score of a CTranslate2 model"""
+    start = time.perf_counter()
+    model = ctranslate2.Translator(model_dir, device=device, compute_type="default")
+    load_time = time.perf_counter() - start
+
+    batch = [tokenizer.encode(t) for t in src_text]
+    start = time.perf_counter()
+    results = model.translate_batch(batch, beam_size=beam_size, max_batch_size=max_batch_size,
+                                    return_scores=False, use_vmap=use_vmap)
+    elapsed = time.perf_counter() - start
+    del model
+
+    hypotheses = [r.hypotheses[0] for r in results]
+    tokens = sum(len(h) for h in hypotheses)
+    translated = [detokenize(h, tokenizer) for h in hypotheses]
+    return {
+        'load_time': load_time,
+        'translate_time': elapsed,
+        'tokens': tokens,
+        'tokens_per_sec': tokens / elapsed if elapsed > 0 else 0.0,
+        'size': model_size(model_dir),
+        'bleu': round(corpus_bleu(translated, [tgt_text]).score, 2),
+    }
+
+def pick_quantization(report, tolerance):
+    """Fastest quantization whose BLEU is within tolerance of float32's
+    (or of the best score, if float32 wasn't benchmarked)"""
+    reference = report['float32']['bleu'] if 'float32' in report else max(r['bleu'] for r in report.values())
+    candidates = [q for q in report if report[q]['bleu'] >= reference - tolerance]
+    return max(candidates, key=lambda q: report[q]['tokens_per_sec'])
+
+def quantization_sweep(convert, output_dir, quantizations, tokenizer, src_text, tgt_text, tolerance=1.0):
+    """Convert a model once per quantization with convert(output_dir, quantization),
+    benchmark each variant on the CPU and keep the fastest one within tolerance
+    BLEU points in output_dir. Returns (quantization, report)"""
+    sweep_dir = output_dir + "-sweep"
+    if os.path.isdir(sweep_dir):
+        shutil.rmtree(sweep_dir)
+
+    report = {}
+    for q in quantizations:
+        variant_dir = os.path.join(sweep_dir, q)
+        print(f"Converting to ctranslate2 using {q}")
+        convert(variant_dir, q)
+        report[q] = benchmark(variant_dir, tokenizer, src_text, tgt_text)
+
+    print(f"{'quantization':<16} {'tokens/s':>10} {'load (s)':>9} {'size (MB)':>10} {'BLEU':>7}")
+    for q, r in report.items():
+        print(f"{q:<16} {r['tokens_per_sec']:>10.0f} {r['load_time']:>9.2f} {r['size'] / (1024 * 1024):>10.1f} {r['bleu']:>7.2f}")
+
+    best = pick_quantization(report, tolerance)
+    print(f"Using {best}")
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    shutil.move(os.path.join(sweep_dir, best), output_dir)
+    shutil.rmtree(sweep_dir)
+    return best, report
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+def peak_rss():
+    """Peak resident memory of this process in bytes (None on Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def benchmark_setting(model_dir, batch, device, compute_type="default", inter_threads=1, intra_threads=0,
+                      max_batch_size=16, beam_size=4, batch_type="examples"):
+    """Throughput of translating the tokenized sentences in batch all at once, and latency
+    of translating them one request (sentence) at a time from inter_threads clients"""
+    start = time.perf_counter()
+    model = ctranslate2.Translator(model_dir, device=device, compute_type=compute_type,
+                                   inter_threads=inter_threads, intra_threads=intra_threads)
+    load_time = time.perf_counter() - start
+    options = {'beam_size': beam_size, 'max_batch_size': max_batch_size, 'batch_type': batch_type, 'return_scores': False}
+
+    # Warm up
+    model.translate_batch(batch[:1], **options)
+
+    start = time.perf_counter()
+    results = model.translate_batch(batch, **options)
+    elapsed = time.perf_counter() - start
+    tokens = sum(len(r.hypotheses[0]) for r in results)
+
+    def request(tokens):
+        start = time.perf_counter()
+        model.translate_batch([tokens], **options)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=inter_threads) as executor:
+        latencies = list(executor.map(request, batch))
+    requests_time = time.perf_counter() - start
+
+    return {
+        'load_time': load_time,
+        'translate_time': elapsed,
+        'tokens': tokens,
+        'tokens_per_sec': tokens / elapsed if elapsed > 0 else 0.0,
+        'sentences_per_sec': len(batch) / elapsed if elapsed > 0 else 0.0,
+        'requests_per_sec': len(batch) / requests_time if requests_time > 0 else 0.0,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'peak_rss': peak_rss(),
+    }
+
+def benchmark_sweep(model_dir, tokenizer, src_text, sweep, device="cpu"):
+    """benchmark_setting for every combination of the values in sweep, which maps
+    benchmark_setting's options to lists. Each setting runs in a new process, so that
+    load time and peak memory are not affected by the previous ones. Returns a list of
+    dicts with the setting and its results"""
+    names = list(sweep.keys())
+    report = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        job_file = os.path.join(tmp_dir, "job.json")
+        result_file = os.path.join(tmp_dir, "result.json")
+        batch = tokenizer.encode_batch(src_text, num_threads=os.cpu_count() or 1)
+
+        for values in itertools.product(*[sweep[n] for n in names]):
+            setting = dict(zip(names, values))
+            print(f"Benchmarking {', '.join(f'{n}={v}' for n, v in setting.items())}")
+            with open(job_file, "w", encoding="utf-8") as f:
+                f.write(json.dumps({'model_dir': model_dir, 'batch': batch, 'device': device, 'setting': setting}))
+            if subprocess.run([sys.executable, os.path.abspath(__file__), job_file, result_file]).returncode != 0:
+                print("Failed, skipping")
+                continue
+            with open(result_file, "r", encoding="utf-8") as f:
+                report.append({**setting, **json.loads(f.read())})
+    return report
+
+if __name__ == "__main__":
+    # Runs a single benchmark_setting job for benchmark_sweep
+    with open(sys.argv[1], "r", encoding="utf-8") as f:
+        job = json.loads(f.read())
+    result = benchmark_setting(job['model_dir'], job['batch'], job['device'], **job['setting'])
+    with open(sys.argv[2], "w", encoding="utf-8") as f:
+        f.write(json.dumps(result))
@@ -0,0 +1,126 @@
+import numpy as np
+
+# Character class flags, one byte per unicode code point
+DIGIT = 1
+NONALNUM = 2 # Not alphanumeric and not a space
+UPPER = 4
+LATIN = 8 # a-z, A-Z
+
+_table = None
+_decimal_values = None
+
+def class_table():
+    global _table
+    if _table is None:
+        chars = np.arange(0x110000, dtype=np.uint32).view('<U1')
+        table = np.zeros(len(chars), dtype=np.uint8)
+        nonalnum = ~np.char.isalnum(chars)
+        nonalnum[ord(' ')] = False
+        latin = ((chars >= 'a') & (chars <= 'z')) | ((chars >= 'A') & (chars <= 'Z'))
+
+        table[np.char.isdigit(chars)] |= DIGIT
+        table[nonalnum] |= NONALNUM
+        table[np.char.isupper(chars)] |= UPPER
+        table[latin] |= LATIN
+        _table = table
+    return _table
+
+def decimal_values():
+    global _decimal_values
+    if _decimal_values is None:
+        chars = np.arange(0x110000, dtype=np.uint32).view('<U1')
+        values = np.zeros(len(chars), dtype=np.uint8)
+        for cp in np.flatnonzero(np.char.isdecimal(chars)):
+            values[cp] = int(chr(cp))
+        _decimal_values = values
+    return _decimal_values
+
+class TextProfile:
+    """Lengths and character class counts of a list of lines.
+    Code points are classified in a single table lookup; counts are
+    computed lazily (and only once) with NumPy"""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self._len = None
+        self._codes = None
+        self._flags = None
+        self._counts = {}
+
+    @property
+    def len(self):
+        if self._len is None:
+            self._len = np.fromiter(map(len, self.lines), dtype=np.int64, count=len(self.lines))
+        return self._len
+
+    @property
+    def codes(self):
+        if self._codes is None:
+            self._codes = np.frombuffer("".join(self.lines).encode("utf-32-le"), dtype=np.uint32)
+        return self._codes
+
+    @property
+    def flags(self):
+        if self._flags is None:
+            self._flags = class_table()[self.codes]
+        return self._flags
+
+    def sum_per_line(self, values):
+        out = np.zeros(len(self.lines), dtype=np.int64)
+        nonempty = self.len > 0
+        if np.any(nonempty):
+            starts = np.cumsum(self.len) - self.len
+            out[nonempty] = np.add.reduceat(values, starts[nonempty], dtype=np.int64)
+        return out
+
+    def count(self, flag):
+        if not flag in self._counts:
+            self._counts[flag] = self.sum_per_line((self.flags & flag) != 0)
+        return self._counts[flag]
+
+    def count_of(self, s):
+        """Number of occurrences of s in each line"""
+        if not s in self._counts:
+            if len(s) == 1:
+                self._counts[s] = self.sum_per_line(self.codes == ord(s))
+            else:
+                self._counts[s] = np.array([l.count(s) for l in self.lines], dtype=np.int64)
+        return self._counts[s]
+
+    @property
+    def digits(self):
+        return self.count(DIGIT)
+
+    @property
+    def nonalnum(self):
+        return self.count(NONALNUM)
+
+    @property
+    def upper(self):
+        return self.count(UPPER)
+
+    @property
+    def latin(self):
+        return self.count(LATIN)
+
+    @property
+    def decimal_sum(self):
+        """Sum of the values of decimal characters in each line"""
+        if not "decimal_sum" in self._counts:
+            self._counts["decimal_sum"] = self.sum_per_line(decimal_values()[self.codes])
+        return self._counts["decimal_sum"]
+
+class BatchProfile:
+    """Profile of a batch of (src, tgt) line pairs, shared by
+    the batch form of all filters in a chain"""
+
+    def __init__(self, src_lines, tgt_lines):
+        self.src = TextProfile(src_lines)
+        self.tgt = TextProfile(tgt_lines)
+        self.keep = None # Lines that passed the previous filters
+
+    def __len__(self):
+        return len(self.src.lines)
+
+    def none(self):
+        return np.zeros(len(self), dtype=bool)
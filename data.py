@@ -1,18 +1,30 @@
 import random
 import os
 import hashlib
-from concurrent.futures import ThreadPoolExecutor
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import mmap
-import time
+import itertools
+from contextlib import contextmanager, ExitStack
+import multiprocessing
 from collections import deque
 import threading
+import time
+import math
+import numpy as np
 from net import download
 import filters as filter_funcs
 import transforms as transform_funcs
 import augmenters as augment_funcs
-from removedup import rdup
-from fastshuffle import file_shuffle_sample
-from io import StringIO
+from charprofile import BatchProfile
+from filterorder import FilterOrder
+from lineindex import LineIndex
+import readers
+from readers import is_compressed, archive_member
+from dedup import HashSet, pair_hashes
+from shuffle import ExternalShuffle
+from profiling import new_profile, record, merge_counters, source_summary, write_report, print_summary
 
 # The list is ordered according to lang_codes found on OPUS
 # Some dialects and scripts listed in flores200 have not been mapped due to lack of resource on OPUS
@@ -214,32 +226,133 @@ nllb_langs = { #Name found on opus as comments, if [] other known alias, () seve
 }
 
 def count_lines(file):
-    def blocks(files, size=65536):
-        while True:
-            b = files.read(size)
-            if not b: break
-            yield b
-
-    with open(file, "r",encoding="utf-8",errors='ignore') as f:
-        return sum(bl.count("\n") for bl in blocks(f))
-
-
-def sources_changed(sources, out_dir):
+    if is_compressed(file):
+        return readers.count_lines(file)
+    return LineIndex(file).newlines
+
+
+def reservoir_sample(lines, k, rng):
+    """k random lines out of an iterator of unknown length, in one pass.
+    Skips ahead between replacements instead of drawing a number per line"""
+    reservoir = list(itertools.islice(lines, k))
+    if len(reservoir) < k or k == 0:
+        return reservoir
+
+    w = math.exp(math.log(1.0 - rng.random()) / k)
+    while True:
+        skip = int(math.log(1.0 - rng.random()) / math.log(1.0 - w))
+        line = next(itertools.islice(lines, skip, skip + 1), None)
+        if line is None:
+            return reservoir
+        reservoir[rng.randrange(k)] = line
+        w *= math.exp(math.log(1.0 - rng.random()) / k)
+
+def sample_lines(file, k, rng, index_dir=None):
+    """k random lines (bytes) of a text file. Plain files are read at random
+    offsets from their line index (stored in index_dir if set), compressed
+    files are sampled in one pass"""
+    if is_compressed(file):
+        lines = reservoir_sample(readers.read_lines(file), k, rng)
+    else:
+        index = LineIndex(file, index_dir)
+        with open(index.data_file, "rb") as f, \
+             mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            lines = [index.read_line(mm, i) for i in index.sample(k, rng)]
+    return [l if l.endswith(b"\n") else l + b"\n" for l in lines]
+
+def write_vocab_sample(corpora, out_file, sentence_size, seed=0, index_dir=None):
+    """Write about sentence_size random lines for training SentencePiece.
+    corpora is a list of (source file, target file, weight). Both languages get
+    half of the lines, split among corpora proportionally to their weights.
+    Line indexes are stored in index_dir, so that dataset folders aren't written to."""
+    rng = random.Random(seed)
+    total_weight = sum([w for _, _, w in corpora])
+    written = 0
+    with open(out_file, "wb") as f:
+        for src, tgt, weight in corpora:
+            k = int(sentence_size / 2 * weight / total_weight)
+            for file in [src, tgt]:
+                lines = sample_lines(file, k, rng, index_dir)
+                f.write(b"".join(lines))
+                written += len(lines)
+    return written
+
+
+# Bump when changes to the merge pipeline invalidate cached outputs
+MERGE_CACHE_VERSION = 2
+
+def file_fingerprint(file, sample_size=1024 * 1024):
+    """Size and modification time of a file plus a hash of its head, middle and tail.
+    The time catches edits outside of the hashed parts that keep the size"""
+    if archive_member(file) is not None:
+        # Archives store a checksum of every member
+        info = readers.member_info(file)
+        return f"{info.file_size}:{info.CRC:08x}"
+
+    st = os.stat(file)
+    size = st.st_size
+    h = hashlib.md5()
+    with open(file, "rb") as f:
+        for pos in sorted(set([0, max(size // 2 - sample_size // 2, 0), max(size - sample_size, 0)])):
+            f.seek(pos)
+            h.update(f.read(sample_size))
+    return f"{size}:{st.st_mtime_ns}:{h.hexdigest()}"
+
+def source_key(source, name):
+    """Cache key of a source's merged output, derived from the contents
+    of its files and its filters, transforms and augmenters"""
+    return hashlib.md5(json.dumps({
+        'version': MERGE_CACHE_VERSION,
+        'name': name,
+        'source': file_fingerprint(source['source']),
+        'target': file_fingerprint(source['target']),
+        'filters': source['filters'],
+        'transforms': source['transforms'],
+        'augmenters': source['augmenters'],
+        'weight': source['weight'],
+    }, sort_keys=True).encode('utf-8')).hexdigest()
+
+def source_keys(sources):
+    """Cache keys of all sources. Stateful filters (near_duplicates) see the lines
+    of every source using them before its own, so the key of such a source
+    also includes the ordered list of these sources"""
+    keys = {k: source_key(sources[k], k) for k in sources}
+    stateful = [k for k in sources if sources[k]['weight'] is None and has_stateful_filters(sources[k])]
+    chain = "|".join(f"{k}:{keys[k]}" for k in stateful)
+    for k in stateful:
+        keys[k] = hashlib.md5(f"{keys[k]}|{chain}".encode('utf-8')).hexdigest()
+    return keys
+
+def get_merge_hash(sources, keys, split=""):
+    return hashlib.md5(("|".join(sorted([f"{k}:{keys[k]}" for k in sources])) + split).encode('utf-8')).hexdigest()
+
+def merge_split(max_eval_sentences=5000, seed=0, stratified_validation=False):
+    # A different seed or validation split needs a new shuffle, but not new filtering
+    return f"|seed:{seed}|val:{max_eval_sentences}|stratified:{stratified_validation}"
+
+def merge_key(sources, max_eval_sentences=5000, seed=0, stratified_validation=False):
+    """Hash of everything the output of merge_shuffle depends on"""
+    keys = source_keys(sources)
+    return get_merge_hash(sources, keys, merge_split(max_eval_sentences, seed, stratified_validation))
+
+def sources_changed(sources, out_dir, keys=None, split=""):
+    if keys is None:
+        keys = source_keys(sources)
     merge_hash_file = os.path.join(out_dir, "merge-hash.txt")
-    sources_hash = hashlib.md5("|".join(sorted([k for k in sources])).encode('utf-8')).hexdigest()
 
     if os.path.isfile(merge_hash_file):
         with open(merge_hash_file, "r", encoding="utf-8") as f:
             merge_hash = f.readline().strip()
-            if merge_hash == sources_hash:
+            if merge_hash == get_merge_hash(sources, keys, split):
                 print("No changes in sources")
                 return False
 
-    with open(merge_hash_file, "w", encoding="utf-8") as f:
-        f.write(sources_hash)
-
     return True
 
+def write_merge_hash(sources, out_dir, keys, split=""):
+    with open(os.path.join(out_dir, "merge-hash.txt"), "w", encoding="utf-8") as f:
+        f.write(get_merge_hash(sources, keys, split))
+
 def get_flores_dataset_path(dataset="dev"):
     if dataset != "dev" and dataset != "devtest":
         print(f"Invalid dataset {dataset} (must be either dev or devtest)")
@@ -295,12 +408,495 @@ def extract_flores_val(src_code, tgt_code, out_dir, dataset="dev"):
             f.write("\n".join(tgt_val) + "\n")
         print(f"Wrote {tgt_f}")
     
-def merge_shuffle(sources, out_dir, max_eval_sentences=5000, remove_duplicates=True):
-    if not sources_changed(sources, out_dir):
+def get_funcs(module, specs):
+    funcs = []
+    for s in specs:
+        if isinstance(s, dict):
+            func_name = list(s.keys())[0]
+            def get_func(name):
+                kwargs = dict(s[name])
+                func = getattr(module, name)
+                lam = lambda src, tgt: func(src, tgt, **kwargs)
+                lam.__name__ = name
+                lam.__args__ = kwargs
+                if hasattr(func, "batch"):
+                    lam.batch = lambda p: func.batch(p, **kwargs)
+                if hasattr(func, "reset"):
+                    lam.reset = lambda: func.reset(**kwargs)
+                lam.stateful = getattr(func, "stateful", False)
+                return lam
+            funcs.append(get_func(func_name))
+        else:
+            funcs.append(getattr(module, s))
+    return funcs
+
+def get_line_range(source, filters):
+    begin_at = None
+    stop_at = None
+    line_count = None
+
+    for f in filters:
+        if f.__name__ == "top":
+            line_count = count_lines(source)
+            print(f"Line count: {line_count}")
+            stop_at = int((f.__args__.get("percent", 100) / 100) * line_count)
+            print(f"Stop at: {stop_at}")
+
+        if f.__name__ == "excerpt":
+            line_count = count_lines(source)
+            print(f"Line count: {line_count}")
+            begin_at = int((f.__args__.get("top_percentile", 100) / 100) * line_count)
+            print(f"Excerpt will begin at line: {begin_at}")
+            stop_at = int((f.__args__.get("bottom_percentile", 100) / 100) * line_count)
+            print(f"Excerpt will end at line: {stop_at}")
+
+    return begin_at, stop_at
+
+def filter_batch(src_lines, tgt_lines, filters, transforms, augmenters, stats, order=None):
+    filtered = stats['filtered']
+    timings = stats['profile']
+    rows = np.arange(len(src_lines)) # Lines of the batch in the profile
+    keep = np.ones(len(src_lines), dtype=bool)
+    profile = BatchProfile(src_lines, tgt_lines)
+
+    for i, f in (order.chain() if order is not None else enumerate(filters)):
+        # Once most lines are rejected, the next filters only profile the others
+        lines = int(np.count_nonzero(keep))
+        if lines < len(keep) // 2 and len(keep) >= 1000:
+            rows = rows[keep]
+            profile = BatchProfile([src_lines[r] for r in rows.tolist()], [tgt_lines[r] for r in rows.tolist()])
+            keep = np.ones(len(rows), dtype=bool)
+
+        start = time.perf_counter()
+        if hasattr(f, "batch"):
+            # Stateful filters must only see lines that passed the previous filters
+            profile.keep = keep
+            rejected = keep & f.batch(profile)
+            n = int(np.count_nonzero(rejected))
+            keep &= ~rejected
+        else:
+            n = 0
+            for j in np.flatnonzero(keep).tolist():
+                if f(profile.src.lines[j], profile.tgt.lines[j]):
+                    keep[j] = False
+                    n += 1
+
+        elapsed = time.perf_counter() - start
+        record(timings['filters'], f.__name__, elapsed, lines, rejected=n)
+        if order is not None:
+            order.observe(i, elapsed, lines, n)
+        if n > 0:
+            filtered[f.__name__] = filtered.get(f.__name__, 0) + n
+
+    if order is not None:
+        order.batch_done()
+
+    pairs = [(src_lines[r], tgt_lines[r]) for r in rows[keep].tolist()]
+    stats['count'] += len(pairs)
+
+    # Each transform and augmenter runs over the whole batch, so that it can be timed
+    for t in transforms:
+        start = time.perf_counter()
+        pairs = [t(line_s, line_t) for line_s, line_t in pairs]
+        record(timings['transforms'], t.__name__, time.perf_counter() - start, len(pairs))
+
+    augmented = []
+    for a in augmenters:
+        start = time.perf_counter()
+        out = [a(line_s, line_t) for line_s, line_t in pairs]
+        added = sum(len(o) for o in out)
+        record(timings['augmenters'], a.__name__, time.perf_counter() - start, len(pairs), added=added)
+        stats['augmented'] += added
+        augmented.append(out)
+
+    if len(augmented) == 0:
+        yield from pairs
+    else:
+        for i, pair in enumerate(pairs):
+            yield pair
+            for out in augmented:
+                yield from out[i]
+
+def filter_lines(pairs, filters, transforms, augmenters, stats, order=None, batch_size=10000):
+    """Decode line pairs and run them through the filter, transform and augmenter chains.
+    Filters are applied to batches of lines, using their batch (vectorized) form when available,
+    in the order given by order (a FilterOrder) if set, otherwise in config order."""
+    src_lines = []
+    tgt_lines = []
+
+    timings = stats['profile']
+    for src_line, tgt_line in pairs:
+        timings['lines_read'] += 1
+        timings['bytes_read'] += len(src_line) + len(tgt_line)
+        line_s = src_line.decode("utf-8").strip()
+        line_t = tgt_line.decode("utf-8").strip()
+
+        # Skip empty
+        if len(line_s) == 0 or len(line_t) == 0:
+            continue
+
+        src_lines.append(line_s)
+        tgt_lines.append(line_t)
+
+        if len(src_lines) >= batch_size:
+            yield from filter_batch(src_lines, tgt_lines, filters, transforms, augmenters, stats, order)
+            src_lines = []
+            tgt_lines = []
+
+    if len(src_lines) > 0:
+        yield from filter_batch(src_lines, tgt_lines, filters, transforms, augmenters, stats, order)
+
+def new_stats():
+    return {'filtered': {}, 'count': 0, 'augmented': 0, 'profile': new_profile()}
+
+def line_range(begin_at=None, stop_at=None):
+    """0-based [first, last) range of lines selected by the top/excerpt filters"""
+    first = max(begin_at - 1, 0) if begin_at is not None else 0
+    last = stop_at + 1 if stop_at is not None else None
+    return first, last
+
+def shard_ranges(source, target, begin_at=None, stop_at=None, shard_size=64 * 1024 * 1024):
+    """Split a source/target pair into ((src_start, src_end), (tgt_start, tgt_end))
+    byte ranges of roughly shard_size bytes, aligned on the same line boundaries
+    in both files"""
+    src_index = LineIndex(source)
+    tgt_index = LineIndex(target)
+    first, last = line_range(begin_at, stop_at)
+    if last is None or last > len(src_index):
+        last = len(src_index)
+    last = max(first, last)
+
+    lines = [first]
+    while True:
+        b = src_index.line_at(src_index.offset(lines[-1]) + shard_size)
+        if b <= lines[-1]:
+            b = lines[-1] + 1
+        if b >= last:
+            break
+        lines.append(b)
+    lines.append(last)
+
+    return [((src_index.offset(lines[i]), src_index.offset(lines[i + 1])),
+             (tgt_index.offset(lines[i]), tgt_index.offset(lines[i + 1]))) for i in range(len(lines) - 1)]
+
+def encode_lines(lines):
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+def write_pairs(pairs, write, batch_size=1000):
+    sbuf, tbuf = [], []
+    for line_s, line_t in pairs:
+        sbuf.append(line_s)
+        tbuf.append(line_t)
+        if len(sbuf) >= batch_size:
+            write(sbuf, tbuf)
+            sbuf, tbuf = [], []
+    if len(sbuf) > 0:
+        write(sbuf, tbuf)
+
+class LineWriter:
+    """Writes batches of (src, tgt) lines to disk from a background thread.
+    Producers block while more than max_buffer_size bytes are waiting to be written,
+    so memory usage stays flat when sources are faster than the disk."""
+
+    def __init__(self, src_file, tgt_file, max_buffer_size=256 * 1024 * 1024):
+        self.src_file = src_file
+        self.tgt_file = tgt_file
+        self.max_buffer_size = max_buffer_size
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.closed = False
+        self.stats = new_profile()['writer']
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.start()
+
+    def write(self, src_lines, tgt_lines):
+        src = encode_lines(src_lines)
+        tgt = encode_lines(tgt_lines)
+        size = len(src) + len(tgt)
+
+        with self.cond:
+            if self.pending_bytes > 0 and self.pending_bytes + size > self.max_buffer_size:
+                start = time.perf_counter()
+                while self.pending_bytes > 0 and self.pending_bytes + size > self.max_buffer_size:
+                    self.cond.wait()
+                self.stats['wait_time'] += time.perf_counter() - start
+            self.pending.append((src, tgt))
+            self.pending_bytes += size
+            self.stats['peak_queue_bytes'] = max(self.stats['peak_queue_bytes'], self.pending_bytes)
+            self.stats['peak_queue_batches'] = max(self.stats['peak_queue_batches'], len(self.pending))
+            self.cond.notify_all()
+
+    def _run(self):
+        with open(self.src_file, "wb") as src, \
+             open(self.tgt_file, "wb") as tgt:
+            while True:
+                with self.cond:
+                    while len(self.pending) == 0 and not self.closed:
+                        self.cond.wait()
+                    if len(self.pending) == 0:
+                        break
+                    batch = list(self.pending)
+                    self.pending.clear()
+
+                start = time.perf_counter()
+                src.write(b"".join(b[0] for b in batch))
+                tgt.write(b"".join(b[1] for b in batch))
+                size = sum(len(b[0]) + len(b[1]) for b in batch)
+                self.stats['time'] += time.perf_counter() - start
+                self.stats['bytes'] += size
+                self.stats['batches'] += 1
+
+                with self.cond:
+                    self.pending_bytes -= size
+                    self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+def source_shards(source, target, begin_at=None, stop_at=None, split=True):
+    """Split a source into shards that can be processed independently: byte ranges
+    of plain text files, or a single line range for compressed files (which can
+    only be read sequentially). Without split and top/excerpt, plain files are a
+    single shard, which doesn't need a line index"""
+    if is_compressed(source) or is_compressed(target):
+        return [("lines",) + line_range(begin_at, stop_at)]
+    if not split and begin_at is None and stop_at is None:
+        return [("bytes", readers.byte_range(source)[1:], readers.byte_range(target)[1:])]
+    return [("bytes", src_range, tgt_range) for src_range, tgt_range in shard_ranges(source, target, begin_at, stop_at)]
+
+def _mm_lines(mm, start, end):
+    # Reads stop at end, where the next member of an archive may begin
+    # (a last line without a newline would run into it)
+    pos = start
+    while pos < end:
+        nl = mm.find(b"\n", pos, end)
+        next_pos = end if nl == -1 else nl + 1
+        yield mm[pos:next_pos]
+        pos = next_pos
+
+@contextmanager
+def open_pairs(source, target, shards):
+    """Line pairs (bytes) of shards of a source"""
+    with ExitStack() as stack:
+        def mm(file):
+            # Members stored in an archive are mapped within the archive
+            fp = stack.enter_context(open(readers.byte_range(file)[0], "rb"))
+            m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            stack.callback(m.close)
+            return m
+
+        def shard_pairs(shard):
+            if shard[0] == "lines":
+                return zip(readers.read_lines(source, *shard[1:]), readers.read_lines(target, *shard[1:]))
+            return zip(_mm_lines(src_mm, *shard[1]), _mm_lines(tgt_mm, *shard[2]))
+
+        if any(shard[0] == "bytes" for shard in shards):
+            src_mm = mm(source)
+            tgt_mm = mm(target)
+        yield itertools.chain.from_iterable(shard_pairs(shard) for shard in shards)
+
+def process_shard(task):
+    source, target, shard, specs, out_prefix = task
+    filters = get_funcs(filter_funcs, specs['filters'])
+    transforms = get_funcs(transform_funcs, specs['transforms'])
+    augmenters = get_funcs(augment_funcs, specs['augmenters'])
+    stats = new_stats()
+
+    with open_pairs(source, target, [shard]) as pairs, \
+         open(out_prefix + ".src", "wb") as src_out, \
+         open(out_prefix + ".tgt", "wb") as tgt_out:
+        def write(src_lines, tgt_lines):
+            src = encode_lines(src_lines)
+            tgt = encode_lines(tgt_lines)
+            start = time.perf_counter()
+            src_out.write(src)
+            tgt_out.write(tgt)
+            writer = stats['profile']['writer']
+            writer['time'] += time.perf_counter() - start
+            writer['bytes'] += len(src) + len(tgt)
+            writer['batches'] += 1
+
+        start = time.perf_counter()
+        order = FilterOrder(filters) if specs.get('adaptive') else None
+        write_pairs(filter_lines(pairs, filters, transforms, augmenters, stats, order), write)
+        stats['profile']['time'] = time.perf_counter() - start
+        if order is not None:
+            stats['profile']['filter_order'] = order.names()
+
+    return stats
+
+def merge_cache_prefix(out_dir, key):
+    return os.path.join(out_dir, "merge-cache", key)
+
+def commit_stats(prefix, stats):
+    with open(prefix + ".json", "w", encoding="utf-8") as f:
+        f.write(json.dumps(stats))
+
+def commit_cache(prefix, stats):
+    os.replace(prefix + ".src.tmp", prefix + ".src")
+    os.replace(prefix + ".tgt.tmp", prefix + ".tgt")
+    commit_stats(prefix, stats)
+
+def read_cache_stats(prefix):
+    with open(prefix + ".json", "r", encoding="utf-8") as f:
+        return json.loads(f.read())
+
+def has_stateful_filters(source):
+    return any(getattr(f, "stateful", False) for f in get_funcs(filter_funcs, source['filters']))
+
+def process_sources(pending, sources, keys, out_dir, processes=None, max_buffer_size=256 * 1024 * 1024, adaptive_filters=False, on_done=None):
+    """Run the filter chains of the pending sources, writing their output to the merge cache.
+    on_done(k, stats) is called as each source completes"""
+    max_workers = min(32, (os.cpu_count() or 1) + 4)
+
+    def done(k, stats):
+        commit_cache(merge_cache_prefix(out_dir, keys[k]), stats)
+        if on_done is not None:
+            on_done(k, stats)
+
+    def process_source(k):
+        source = sources[k]['source']
+        target = sources[k]['target']
+
+        filters = get_funcs(filter_funcs, sources[k]['filters'])
+        transforms = get_funcs(transform_funcs, sources[k]['transforms'])
+        augmenters = get_funcs(augment_funcs, sources[k]['augmenters'])
+
+        print(f"Reading {source} - {target}")
+        begin_at, stop_at = get_line_range(source, filters)
+        stats = new_stats()
+
+        prefix = merge_cache_prefix(out_dir, keys[k])
+        start = time.perf_counter()
+        writer = LineWriter(prefix + ".src.tmp", prefix + ".tgt.tmp", max_buffer_size // max_workers)
+        try:
+            # Seek straight to the lines selected by top/excerpt
+            with open_pairs(source, target, source_shards(source, target, begin_at, stop_at, split=False)) as pairs:
+                order = FilterOrder(filters) if adaptive_filters else None
+                write_pairs(filter_lines(pairs, filters, transforms, augmenters, stats, order), writer.write)
+                if order is not None:
+                    stats['profile']['filter_order'] = order.names()
+                    print(f"Filter order for {k}: {' > '.join(order.names())}")
+        finally:
+            writer.close()
+
+        stats['profile']['time'] = time.perf_counter() - start
+        stats['profile']['writer'] = writer.stats
+        done(k, stats)
+
+    def process_sources_parallel():
+        # Split every source into shards and run the filter chains in worker processes,
+        # then concatenate the shard outputs in a deterministic order
+        shards_dir = os.path.join(out_dir, "shards")
+        os.makedirs(shards_dir, exist_ok=True)
+
+        tasks = []
+        owners = []
+        for k in pending:
+            source = sources[k]['source']
+            target = sources[k]['target']
+            specs = {
+                'filters': sources[k]['filters'],
+                'transforms': sources[k]['transforms'],
+                'augmenters': sources[k]['augmenters'],
+                'adaptive': adaptive_filters,
+            }
+
+            print(f"Reading {source} - {target}")
+            filters = get_funcs(filter_funcs, specs['filters'])
+            begin_at, stop_at = get_line_range(source, filters)
+            for i, shard in enumerate(source_shards(source, target, begin_at, stop_at)):
+                tasks.append((source, target, shard, specs, os.path.join(shards_dir, f"{keys[k]}_{i}")))
+                owners.append(k)
+
+        print(f"Processing {len(tasks)} shards using {processes} processes")
+        source_stats = {}
+        outputs = {}
+        # train.py is a plain script, spawned workers would re-run it on import
+        mp_context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+        with ProcessPoolExecutor(max_workers=processes, mp_context=mp_context) as executor:
+            for i, (task, k, stats) in enumerate(zip(tasks, owners, executor.map(process_shard, tasks))):
+                if not k in outputs:
+                    prefix = merge_cache_prefix(out_dir, keys[k])
+                    outputs[k] = (open(prefix + ".src.tmp", "wb"), open(prefix + ".tgt.tmp", "wb"))
+
+                out_prefix = task[-1]
+                for ext, out in zip([".src", ".tgt"], outputs[k]):
+                    with open(out_prefix + ext, "rb") as f:
+                        shutil.copyfileobj(f, out, 1024 * 1024)
+                    os.unlink(out_prefix + ext)
+
+                merge_counters(source_stats.setdefault(k, {}), stats)
+                s = source_stats[k]
+
+                # Last shard of this source?
+                if i == len(tasks) - 1 or owners[i + 1] != k:
+                    for out in outputs[k]:
+                        out.close()
+                    print(k)
+                    done(k, s)
+
+        shutil.rmtree(shards_dir)
+
+    # Stateful filters (near_duplicates) keep the first copy of the lines they see,
+    # so the sources using them are processed one at a time, in order, with the
+    # state reset first, so that the same lines are kept at every run
+    stateful = [k for k in pending if has_stateful_filters(sources[k])]
+    pending = [k for k in pending if not k in stateful]
+
+    if len(pending) == 0:
+        pass
+    elif processes is not None and processes > 1:
+        process_sources_parallel()
+    else:
+        # for s in sources:
+        #     process_source(s)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in executor.map(process_source, pending):
+                pass
+
+    for k in stateful:
+        for f in get_funcs(filter_funcs, sources[k]['filters']):
+            if hasattr(f, "reset"):
+                f.reset()
+    for k in stateful:
+        process_source(k)
+
+def prepare_source(k, source, out_dir, processes=None, max_buffer_size=256 * 1024 * 1024, adaptive_filters=False):
+    """Process a source into the merge cache ahead of merge_shuffle, for example
+    while other sources are still downloading. Weighted sources and sources with
+    stateful filters are left to merge_shuffle. Returns True if the source is ready"""
+    if source['weight'] is not None or has_stateful_filters(source):
+        return False
+
+    key = source_key(source, k)
+    prefix = merge_cache_prefix(out_dir, key)
+    if os.path.isfile(prefix + ".json"):
+        return True
+
+    def mark_prepared(k, stats):
+        stats['prepared'] = True
+        commit_stats(prefix, stats)
+        print(f"Prepared {k}")
+
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    process_sources([k], {k: source}, {k: key}, out_dir, processes, max_buffer_size, adaptive_filters, on_done=mark_prepared)
+    return True
+
+def merge_shuffle(sources, out_dir, max_eval_sentences=5000, remove_duplicates=True, processes=None, max_buffer_size=256 * 1024 * 1024, max_dedup_memory=1024 * 1024 * 1024, max_shuffle_memory=1024 * 1024 * 1024, seed=0, stratified_validation=False, adaptive_filters=False):
+    keys = source_keys(sources)
+    split = merge_split(max_eval_sentences, seed, stratified_validation)
+    outputs = [os.path.join(out_dir, f) for f in ["src-train.txt", "tgt-train.txt", "src-val.txt", "tgt-val.txt"]]
+    if all(os.path.isfile(f) for f in outputs) and not sources_changed(sources, out_dir, keys, split):
         return False
 
-    lines = deque()
     total_count = 0
+    merge_start = time.perf_counter()
+    report = {'sources': {}, 'duplicates': {}, 'time': {}}
 
     src_train = os.path.join(out_dir, "src-train.txt")
     tgt_train = os.path.join(out_dir, "tgt-train.txt")
@@ -308,205 +904,120 @@ def merge_shuffle(sources, out_dir, max_eval_sentences=5000, remove_duplicates=T
         if os.path.isfile(f):
             os.unlink(f)
 
-    def process_source(k):
-        nonlocal total_count
-        source = sources[k]['source']
-        target = sources[k]['target']
-        if sources[k]['weight'] is not None:
-            return
-        
-        filters = []
-        transforms = []
-        augmenters = []
-
-        for f in sources[k]['filters']:
-            if isinstance(f, dict):
-                func_name = list(f.keys())[0]
-                def get_func(name):
-                    kwargs = dict(f[name])
-                    func = getattr(filter_funcs, name)
-                    lam = lambda src, tgt: func(src, tgt, **kwargs)
-                    lam.__name__ = name
-                    lam.__args__ = kwargs
-                    return lam 
-                filters.append(get_func(func_name))
-            else:
-                filters.append(getattr(filter_funcs, f))
-        
-        for t in sources[k]['transforms']:
-            if isinstance(t, dict):
-                func_name = list(t.keys())[0]
-                def get_func(name):
-                    kwargs = dict(t[name])
-                    func = getattr(transform_funcs, name)
-                    lam = lambda src, tgt: func(src, tgt, **kwargs)
-                    lam.__name__ = name
-                    return lam
-                transforms.append(get_func(func_name))
-            else:
-                transforms.append(getattr(transform_funcs, t))
-
-        for a in sources[k]['augmenters']:
-            if isinstance(a, dict):
-                func_name = list(a.keys())[0]
-                def get_func(name):
-                    kwargs = dict(a[name])
-                    func = getattr(augment_funcs, name)
-                    lam = lambda src, tgt: func(src, tgt, **kwargs)
-                    lam.__name__ = name
-                    return lam
-                augmenters.append(get_func(func_name))
-            else:
-                augmenters.append(getattr(augment_funcs, a))
+    # The filtered output of each source is cached by key,
+    # so that only sources that changed need to be processed again
+    cache_dir = os.path.join(out_dir, "merge-cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    merged = [k for k in sources if sources[k]['weight'] is None]
+    cache_files = set([f"{keys[k]}{ext}" for k in merged for ext in [".src", ".tgt", ".json"]])
+    for f in os.listdir(cache_dir):
+        if not f in cache_files:
+            os.unlink(os.path.join(cache_dir, f))
 
+    def cache_prefix(k):
+        return merge_cache_prefix(out_dir, keys[k])
 
-        print(f"Reading {source} - {target}")
-        filtered = {}
-        count = 0
-        augmented = 0
-        line_no = 0
-        begin_at = None
-        stop_at = None
-        line_count = None
-
-        for f in filters:
-            if f.__name__ == "top":
-                line_count = count_lines(source)
-                print(f"Line count: {line_count}")
-                stop_at = int((f.__args__.get("percent", 100) / 100) * line_count)
-                print(f"Stop at: {stop_at}")
-
-            if f.__name__ == "excerpt":
-                line_count = count_lines(source)
-                print(f"Line count: {line_count}")
-                begin_at = int((f.__args__.get("top_percentile", 100) / 100) * line_count)
-                print(f"Excerpt will begin at line: {begin_at}")
-                stop_at = int((f.__args__.get("bottom_percentile", 100) / 100) * line_count)
-                print(f"Excerpt will end at line: {stop_at}")
-
-        with open(source, "r+b") as src_fp, \
-             open(target, "r+b") as tgt_fp:
-            src_mm = mmap.mmap(src_fp.fileno(), 0)
-            tgt_mm = mmap.mmap(tgt_fp.fileno(), 0)
-            src_it = iter(src_mm.readline, b"")
-            tgt_it = iter(tgt_mm.readline, b"")
-
-            for src_line in src_it:
-                #Exit after "stop_at" line if excerpt or top filter on
-                if stop_at is not None and line_no > stop_at:
-                    print(f"Finished collecting before line {line_no}")
-                    break
+    def is_cached(k):
+        return os.path.isfile(cache_prefix(k) + ".json")
 
-                line_s = src_line.decode("utf-8").strip()
-                line_t = next(tgt_it).decode("utf-8").strip()
-                
-                #Start counting every line ('count' excludes filtered lines)
-                line_no += 1
-                
-                # Skip lines until begin_at if excerpt filter on
-                if begin_at is not None and line_no < begin_at:
-                    continue
-                
-                # Skip empty
-                if len(line_s) == 0 or len(line_t) == 0:
-                    continue
-                
-                skip = False
-                for f in filters:
-                    if f(line_s, line_t):
-                        skip = True
-                        filtered[f.__name__] = filtered.get(f.__name__, 0) + 1
-                        break
-                
-                if skip:
-                    continue
-
-                count += 1
-
-                for t in transforms:
-                    line_s, line_t = t(line_s, line_t)
-                
-                lines.append((line_s + '\n', line_t + '\n'))
-
-                for a in augmenters:
-                    for a_src, a_tgt in a(line_s, line_t):
-                        lines.append((a_src + '\n', a_tgt + '\n'))
-                        augmented += 1
-            src_mm.close()
-            tgt_mm.close()
-
-        print(filtered)
-        print(f"Filtered {sum(filtered.values())} lines")
-        total_count += count + augmented
-        print(f"Added: {count + augmented} lines")
+    def print_stats(k, stats, cached=False):
+        nonlocal total_count
+        report['sources'][k] = source_summary(stats)
+        report['sources'][k]['cached'] = cached
+        print(stats['filtered'])
+        print(f"Filtered {sum(stats['filtered'].values())} lines")
+        total_count += stats['count'] + stats['augmented']
+        print(f"Added: {stats['count'] + stats['augmented']} lines")
         print(f"New sentence count: {total_count}")
 
-    finished = False
-
-    def write_lines():
-        with open(os.path.join(out_dir, "src.txt"), "w", encoding="utf-8") as src, \
-             open(os.path.join(out_dir, "tgt.txt"), "w", encoding="utf-8") as tgt:
-             while True:
-                count = len(lines)
-                if count > 0:
-                    sbuf = StringIO()
-                    tbuf = StringIO()
-
-                    for x in range(count):
-                        l = lines.popleft()
-                        sbuf.write(l[0])
-                        tbuf.write(l[1])
-
-                    src.write(sbuf.getvalue())
-                    tgt.write(tbuf.getvalue())
-                elif finished:
+    # Stateful filters (near_duplicates) depend on the lines of all the sources using them,
+    # so if one of these sources changed, all of them are processed again
+    stateful = [k for k in merged if has_stateful_filters(sources[k])]
+    stateful_changed = any(not is_cached(k) for k in stateful)
+
+    pending = []
+    for k in merged:
+        if is_cached(k) and not (stateful_changed and k in stateful):
+            stats = read_cache_stats(cache_prefix(k))
+            # Sources processed by prepare_source during this run aren't cached results
+            prepared = stats.pop('prepared', False)
+            if not prepared:
+                print(f"Using cached {k}")
+            print_stats(k, stats, cached=not prepared)
+            if prepared:
+                commit_stats(cache_prefix(k), stats)
+        else:
+            pending.append(k)
+
+    if len(pending) > 0:
+        process_sources(pending, sources, keys, out_dir, processes, max_buffer_size, adaptive_filters, on_done=print_stats)
+
+    report['time']['process'] = time.perf_counter() - merge_start
+    step_start = time.perf_counter()
+
+    # Concatenate in a deterministic order, dropping duplicate pairs,
+    # and partition the pairs for shuffling
+    expected_size = sum(os.path.getsize(cache_prefix(k) + ext) for k in merged for ext in [".src", ".tgt"])
+    shuffler = ExternalShuffle(expected_size, total_count, max_shuffle_memory, seed, tmp_dir=out_dir)
+    seen = HashSet(max_dedup_memory, tmp_dir=out_dir) if remove_duplicates else None
+    removed = {}
+
+    for idx, k in enumerate(merged):
+        removed[k] = 0
+        with open(cache_prefix(k) + ".src", "rb") as src_in, \
+             open(cache_prefix(k) + ".tgt", "rb") as tgt_in:
+            while True:
+                src_lines = list(itertools.islice(src_in, 100000))
+                tgt_lines = list(itertools.islice(tgt_in, len(src_lines)))
+                if len(src_lines) == 0:
                     break
-                else:
-                    time.sleep(0.2)
-
-    writer = threading.Thread(target=write_lines)
-    writer.start()
-
-    # for s in sources:
-    #     process_source(s)
-    with ThreadPoolExecutor() as executor:
-        executor.map(process_source, list(sources.keys()))    
-    finished = True
-    writer.join()
-
-    src_txt = os.path.join(out_dir, "src.txt")
-    tgt_txt =  os.path.join(out_dir, "tgt.txt")
-
-    if remove_duplicates:
-        print("Removing duplicates")
-        src_dedup, tgt_dedup, removed = rdup(src_txt, tgt_txt)
-        print(f"Removed {removed} lines")
-        os.unlink(src_txt)
-        os.unlink(tgt_txt)
-        os.rename(src_dedup, src_txt)
-        os.rename(tgt_dedup, tgt_txt)
+
+                if seen is not None:
+                    keep = seen.add(pair_hashes(src_lines, tgt_lines))
+                    removed[k] += len(keep) - int(np.count_nonzero(keep))
+                    src_lines = list(itertools.compress(src_lines, keep))
+                    tgt_lines = list(itertools.compress(tgt_lines, keep))
+
+                shuffler.add(src_lines, tgt_lines, idx)
+
+    if seen is not None:
+        seen.close()
+        print("Duplicates removed")
+        for k in removed:
+            print(f" - {k}: {removed[k]}")
+        print(f"Removed {sum(removed.values())} lines")
+        total_count -= sum(removed.values())
+        report['duplicates'] = removed
+    report['time']['concat'] = time.perf_counter() - step_start
 
     if total_count * 0.2 < max_eval_sentences:
         max_eval_sentences = total_count * 0.2
     max_eval_sentences = int(max_eval_sentences)
 
     if total_count == 0:
+        shuffler.close()
         print("No sources merged")
         return
 
     print(f"Training size: {total_count - max_eval_sentences}")
     print(f"Validation size: {max_eval_sentences}")
 
-    print("Writing shuffled sets")
+    print(f"Writing shuffled sets ({shuffler.partitions} partitions, seed: {seed})")
     os.makedirs(out_dir, exist_ok=True)
 
-    src, tgt, src_sample, tgt_sample = file_shuffle_sample(src_txt, tgt_txt, max_eval_sentences)
-    os.rename(src, src_train)
-    os.rename(tgt, tgt_train)
-    os.rename(src_sample, os.path.join(out_dir, "src-val.txt"))
-    os.rename(tgt_sample, os.path.join(out_dir, "tgt-val.txt"))
+    step_start = time.perf_counter()
+    shuffler.write(src_train, tgt_train,
+                   os.path.join(out_dir, "src-val.txt"), os.path.join(out_dir, "tgt-val.txt"),
+                   max_eval_sentences, stratified_validation)
+    report['time']['shuffle'] = time.perf_counter() - step_start
+    report['time']['total'] = time.perf_counter() - merge_start
+    report['train_size'] = total_count - max_eval_sentences
+    report['validation_size'] = max_eval_sentences
+
+    report['sources'] = {k: report['sources'][k] for k in merged}
+    write_report(report, os.path.join(out_dir, "merge-report.json"))
+    print_summary(report)
 
-    os.unlink(src_txt)
-    os.unlink(tgt_txt)
+    write_merge_hash(sources, out_dir, keys, split)
 
     return True
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+
+class HashSet:
+    """Set of 64-bit hashes stored as sorted NumPy runs (8 bytes per entry).
+    Runs are merged as they grow, and spilled to disk (memory mapped) when
+    the in-memory runs exceed max_memory bytes."""
+
+    def __init__(self, max_memory=1024 * 1024 * 1024, tmp_dir=None):
+        self.max_memory = max_memory
+        self.runs = []
+        self.disk_runs = []
+        self.tmp_dir = tempfile.mkdtemp(prefix="dedup-", dir=tmp_dir)
+
+    def __len__(self):
+        return sum(len(r) for r in self.runs) + sum(len(r) for r in self.disk_runs)
+
+    def _contains(self, hashes):
+        found = np.zeros(len(hashes), dtype=bool)
+        for run in self.runs + self.disk_runs:
+            if len(run) == 0:
+                continue
+            pos = np.searchsorted(run, hashes)
+            pos[pos == len(run)] = 0
+            found |= run[pos] == hashes
+        return found
+
+    def add(self, hashes):
+        """Add a batch of hashes (np.uint64), returning a mask of those
+        that were not already in the set (only the first of repeated hashes in
+        the batch is considered new)"""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        new = np.zeros(len(hashes), dtype=bool)
+        if len(hashes) == 0:
+            return new
+
+        # Lookups are much faster with sorted keys
+        order = np.argsort(hashes, kind='stable')
+        keys = hashes[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        first &= ~self._contains(keys)
+        new[order[first]] = True
+
+        self.runs.append(keys[first])
+
+        # Keep run sizes geometric so that lookups touch few runs
+        while len(self.runs) > 1 and len(self.runs[-1]) * 2 >= len(self.runs[-2]):
+            last = self.runs.pop()
+            self.runs[-1] = np.sort(np.concatenate((self.runs[-1], last)), kind='stable')
+
+        if sum(r.nbytes for r in self.runs) > self.max_memory:
+            self._spill()
+
+        return new
+
+    def _spill(self):
+        run = np.sort(np.concatenate(self.runs), kind='stable')
+        self.runs = []
+        run_file = os.path.join(self.tmp_dir, f"run_{len(self.disk_runs)}.npy")
+        np.save(run_file, run)
+        self.disk_runs.append(np.load(run_file, mmap_mode='r'))
+
+    def close(self):
+        self.runs = []
+        self.disk_runs = []
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+def pair_hashes(src_lines, tgt_lines):
+    return np.fromiter((hash(p) for p in zip(src_lines, tgt_lines)), dtype=np.int64, count=len(src_lines)).view(np.uint64)
@@ -7,6 +7,7 @@ import subprocess
 from sacrebleu import corpus_bleu
 from data import get_flores, get_flores_file_path
 from tokenizer import BPETokenizer, SentencePieceTokenizer
+from benchmark import benchmark, benchmark_sweep, model_size
 
 parser = argparse.ArgumentParser(description='Evaluate LibreTranslate compatible models')
 parser.add_argument('--config',
@@ -41,8 +42,53 @@ parser.add_argument('--cpu',
     help='Force CPU use. Default: %(default)s')
 parser.add_argument('--max-batch-size',
     type=int,
-    default=16,
-    help='Max batch size for translation. Default: %(default)s')
+    nargs='+',
+    default=[16],
+    help='Max batch size for translation. With --benchmark, several values can be compared. Default: %(default)s')
+parser.add_argument('--vmap',
+    action="store_true",
+    help='Compare speed and BLEU score with and without the vocabulary map (vmap). Default: %(default)s')
+parser.add_argument('--benchmark',
+    action="store_true",
+    help='Measure throughput, latency, load time and memory use for each combination of --beam-size, --max-batch-size, --batch-type, --compute-type, --inter-threads and --intra-threads. Default: %(default)s')
+parser.add_argument('--benchmark-corpus',
+    type=str,
+    default=None,
+    help='Text file to translate with --benchmark, one sentence per line. Default: the flores200 dataset')
+parser.add_argument('--benchmark-sentences',
+    type=int,
+    default=None,
+    help='Only translate the first N sentences with --benchmark. Default: all')
+parser.add_argument('--benchmark-output',
+    type=str,
+    default=None,
+    help='JSON file to write the --benchmark results to. Default: benchmark.json in the run directory')
+parser.add_argument('--beam-size',
+    type=int,
+    nargs='+',
+    default=[4],
+    help='Beam sizes to compare with --benchmark. Default: %(default)s')
+parser.add_argument('--batch-type',
+    type=str,
+    nargs='+',
+    choices=["examples", "tokens"],
+    default=["examples"],
+    help='Whether --max-batch-size counts sentences or tokens, with --benchmark. Default: %(default)s')
+parser.add_argument('--compute-type',
+    type=str,
+    nargs='+',
+    default=["default"],
+    help='CTranslate2 compute types to compare with --benchmark (e.g. int8 int8_float32 float32). Default: %(default)s')
+parser.add_argument('--inter-threads',
+    type=int,
+    nargs='+',
+    default=[1],
+    help='Number of translations run in parallel, to compare with --benchmark. Default: %(default)s')
+parser.add_argument('--intra-threads',
+    type=int,
+    nargs='+',
+    default=[0],
+    help='Threads per translation (0 for CTranslate2\'s default), to compare with --benchmark. Default: %(default)s')
 
 
 
@@ -69,14 +115,17 @@ if not os.path.isdir(ct2_model_dir) or (not os.path.isfile(sp_model) and not os.
     exit(1)
 
 
-def translator():
-    device = "cuda" if ctranslate2.get_cuda_device_count() > 0 and not args.cpu else "cpu"
-    model = ctranslate2.Translator(ct2_model_dir, device=device, compute_type="default")
+device = "cuda" if ctranslate2.get_cuda_device_count() > 0 and not args.cpu else "cpu"
+
+def load_tokenizer():
     if os.path.isfile(sp_model):
-        tokenizer = SentencePieceTokenizer(sp_model)
+        return SentencePieceTokenizer(sp_model)
     elif os.path.isfile(bpe_model):
-        tokenizer = BPETokenizer(bpe_model, config["from"]["code"], config["to"]["code"])
-    return {"model": model, "tokenizer": tokenizer}
+        return BPETokenizer(bpe_model, config["from"]["code"], config["to"]["code"])
+
+def translator():
+    model = ctranslate2.Translator(ct2_model_dir, device=device, compute_type="default")
+    return {"model": model, "tokenizer": load_tokenizer()}
 
 def encode(text, tokenizer):
     return tokenizer.encode(text)
@@ -99,8 +148,70 @@ def translate_flores():
             translation_file.write("\n")
     return tra_f
 
+if args.benchmark:
+    # Each setting loads its own model
+    if args.benchmark_corpus is not None:
+        with open(args.benchmark_corpus, "r", encoding="utf-8") as f:
+            src_text = [line.rstrip('\n') for line in f]
+    else:
+        src_text = get_flores(config["from"]["code"], args.flores_dataset)
+    if args.benchmark_sentences is not None:
+        src_text = src_text[:args.benchmark_sentences]
+
+    sweep = {
+        'compute_type': args.compute_type,
+        'inter_threads': args.inter_threads,
+        'intra_threads': args.intra_threads,
+        'batch_type': args.batch_type,
+        'max_batch_size': args.max_batch_size,
+        'beam_size': args.beam_size,
+    }
+    results = benchmark_sweep(ct2_model_dir, load_tokenizer(), src_text, sweep, device=device)
+    if len(results) == 0:
+        print("All benchmarks failed")
+        exit(1)
+
+    print(f"{'compute_type':<14} {'inter':>5} {'intra':>5} {'batch':>12} {'beam':>4} {'tokens/s':>9} {'sents/s':>8} {'req/s':>7} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'load (s)':>8} {'RSS (MB)':>9}")
+    for r in results:
+        rss = f"{r['peak_rss'] / (1024 * 1024):.0f}" if r['peak_rss'] is not None else "-"
+        print(f"{r['compute_type']:<14} {r['inter_threads']:>5} {r['intra_threads']:>5} {str(r['max_batch_size']) + ' ' + r['batch_type']:>12} {r['beam_size']:>4} "
+              f"{r['tokens_per_sec']:>9.0f} {r['sentences_per_sec']:>8.1f} {r['requests_per_sec']:>7.1f} {r['latency_p50'] * 1000:>9.1f} {r['latency_p95'] * 1000:>9.1f} {r['latency_p99'] * 1000:>9.1f} "
+              f"{r['load_time']:>8.2f} {rss:>9}")
+
+    report = {
+        'model': model_dirname,
+        'from': config['from']['code'],
+        'to': config['to']['code'],
+        'version': config['version'],
+        'size': model_size(ct2_model_dir),
+        'ctranslate2': ctranslate2.__version__,
+        'device': device,
+        'cpu_count': os.cpu_count(),
+        'corpus': os.path.abspath(args.benchmark_corpus) if args.benchmark_corpus is not None else f"flores200 {args.flores_dataset}",
+        'sentences': len(src_text),
+        'results': results,
+    }
+    output = args.benchmark_output or os.path.join(run_dir, "benchmark.json")
+    with open(output, "w", encoding="utf-8") as f:
+        f.write(json.dumps(report, indent=4))
+    print(f"Wrote {output}")
+    exit(0)
+
 data = translator()
-if args.bleu or args.flores_id or args.translate_flores or args.comet:
+if args.vmap:
+    if not os.path.isfile(os.path.join(ct2_model_dir, "vmap.txt")):
+        print(f"There's no vmap.txt in {ct2_model_dir}. Set \"vmap\": true in the config and run train.py")
+        exit(1)
+    src_text = get_flores(config["from"]["code"], args.flores_dataset)
+    tgt_text = get_flores(config["to"]["code"], args.flores_dataset)
+    results = {}
+    for use_vmap in [False, True]:
+        results[use_vmap] = benchmark(ct2_model_dir, data["tokenizer"], src_text, tgt_text, device=device,
+                                      max_batch_size=args.max_batch_size[0], use_vmap=use_vmap)
+        print(f"{'With' if use_vmap else 'Without'} vmap: {results[use_vmap]['tokens_per_sec']:.0f} tokens/s, BLEU score: {results[use_vmap]['bleu']}")
+    print(f"Speedup: {results[True]['tokens_per_sec'] / results[False]['tokens_per_sec']:.2f}x, "
+          f"BLEU change: {results[True]['bleu'] - results[False]['bleu']:+.2f}")
+elif args.bleu or args.flores_id or args.translate_flores or args.comet:
     if args.flores_dataset:
         dataset = args.flores_dataset
     src_text = get_flores(config["from"]["code"], dataset)
@@ -114,7 +225,7 @@ if args.bleu or args.flores_id or args.translate_flores or args.comet:
         [encode(t, data["tokenizer"]) for t in src_text],
         beam_size=4, # same as argos
         return_scores=False, # speed up,
-        max_batch_size=args.max_batch_size,
+        max_batch_size=args.max_batch_size[0],
     )
 
     translated_text = [
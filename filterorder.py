@@ -0,0 +1,66 @@
+class FilterOrder:
+    """Adaptive order of a filter chain. The chain runs in config order for the
+    first warmup batches while each filter's cost per line and rejection rate are
+    measured, then filters are sorted by cost / rejection rate (cheap, selective
+    filters first), which minimizes the expected cost per line. The order is
+    checked again every recheck batches, giving recent batches more weight.
+
+    Stateful filters (e.g. near_duplicates) act as barriers: no filter is moved
+    across them, so they always see the same lines. The lines that are kept don't
+    depend on the order, but a line rejected by several filters is counted for
+    the first one that ran."""
+
+    def __init__(self, filters, warmup=2, recheck=20):
+        self.filters = filters
+        self.warmup = warmup
+        self.recheck = recheck
+        self.order = list(range(len(filters)))
+        self.batches = 0
+        # time, lines, rejected
+        self.measures = [[0.0, 0, 0] for _ in filters]
+
+    def chain(self):
+        return [(i, self.filters[i]) for i in self.order]
+
+    def observe(self, i, elapsed, lines, rejected):
+        m = self.measures[i]
+        m[0] += elapsed
+        m[1] += lines
+        m[2] += rejected
+
+    def _rank(self, i):
+        elapsed, lines, rejected = self.measures[i]
+        if lines == 0:
+            # Not measured yet (all lines were rejected before), keep it late
+            return float("inf")
+        if rejected == 0:
+            return float("inf")
+        return (elapsed / lines) / (rejected / lines)
+
+    def batch_done(self):
+        self.batches += 1
+        if self.batches < self.warmup or (self.batches - self.warmup) % self.recheck != 0:
+            return False
+
+        order = []
+        segment = []
+        for i in range(len(self.filters)):
+            if getattr(self.filters[i], "stateful", False):
+                order += sorted(segment, key=self._rank) + [i]
+                segment = []
+            else:
+                segment.append(i)
+        order += sorted(segment, key=self._rank)
+
+        # Older measures count for half at each check
+        for m in self.measures:
+            m[0] /= 2
+            m[1] //= 2
+            m[2] //= 2
+
+        changed = order != self.order
+        self.order = order
+        return changed
+
+    def names(self):
+        return [self.filters[i].__name__ for i in self.order]
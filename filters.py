@@ -31,6 +31,11 @@ def char_length(src, tgt, min = 0, max = float("inf")):
     return len(src) <= min or len(src) >= max or \
            len(tgt) <= min or len(tgt) >= max
 
+def _char_length_batch(p, min = 0, max = float("inf")):
+    return (p.src.len <= min) | (p.src.len >= max) | \
+           (p.tgt.len <= min) | (p.tgt.len >= max)
+char_length.batch = _char_length_batch
+
 def source_target_ratio(src, tgt, min = 0, max = float("inf")):
     """
     Removes lines when the ratio (len(source) / len(target)) is outside of bounds
@@ -41,12 +46,21 @@ def source_target_ratio(src, tgt, min = 0, max = float("inf")):
     ratio = len(src) / len(tgt)
     return ratio <= min or ratio >= max
 
+def _source_target_ratio_batch(p, min = 0, max = float("inf")):
+    ratio = p.src.len / p.tgt.len
+    return (ratio <= min) | (ratio >= max)
+source_target_ratio.batch = _source_target_ratio_batch
+
 def uppercase_count_mismatch(src, tgt):
     """
     Removes lines when source and target have a different number of uppercase letters
     """
     return sum(1 for ch in src if ch.isupper()) != sum(1 for ch in tgt if ch.isupper())
 
+def _uppercase_count_mismatch_batch(p):
+    return p.src.upper != p.tgt.upper
+uppercase_count_mismatch.batch = _uppercase_count_mismatch_batch
+
 def contains(src, tgt, words = []):
     """
     Removes lines that contain these words
@@ -68,6 +82,11 @@ def digits_ratio(src, tgt, max = 0.4):
     return len([c for c in src if c.isdigit()]) / len(src) >= max or \
                 len([c for c in tgt if c.isdigit()]) / len(tgt) >= max
 
+def _digits_ratio_batch(p, max = 0.4):
+    return (p.src.digits / p.src.len >= max) | \
+           (p.tgt.digits / p.tgt.len >= max)
+digits_ratio.batch = _digits_ratio_batch
+
 def nonalphanum_ratio(src, tgt, max = 0.4):
     """
     Removes lines when the ratio of non-alphanumeric characters to the total length of the line
@@ -78,6 +97,11 @@ def nonalphanum_ratio(src, tgt, max = 0.4):
     return len([c for c in src if c != ' ' and (not c.isalnum())]) / len(src) >= max or \
                 len([c for c in tgt if c != ' ' and (not c.isalnum())]) / len(tgt) >= max
 
+def _nonalphanum_ratio_batch(p, max = 0.4):
+    return (p.src.nonalnum / p.src.len >= max) | \
+           (p.tgt.nonalnum / p.tgt.len >= max)
+nonalphanum_ratio.batch = _nonalphanum_ratio_batch
+
 def digits_mismatch(src, tgt):
     """
     Removes lines when there are digits in source and not in target, or vice-versa
@@ -86,12 +110,22 @@ def digits_mismatch(src, tgt):
     t = sum(int(num) for num in tgt if num.isdecimal())
     return (s == 0 and t > 0) or (t == 0 and s > 0)
 
+def _digits_mismatch_batch(p):
+    s = p.src.decimal_sum
+    t = p.tgt.decimal_sum
+    return ((s == 0) & (t > 0)) | ((t == 0) & (s > 0))
+digits_mismatch.batch = _digits_mismatch_batch
+
 def nonalphanum_count_mismatch(src, tgt):
     """
     Removes lines when the sum of non-alphanumeric characters (except spaces) between source and target is not the same
     """
     return sum(1 for ch in src if ch != " " and (not ch.isalnum())) != sum(1 for ch in tgt if ch != " " and (not ch.isalnum()))
 
+def _nonalphanum_count_mismatch_batch(p):
+    return p.src.nonalnum != p.tgt.nonalnum
+nonalphanum_count_mismatch.batch = _nonalphanum_count_mismatch_batch
+
 def characters_count_mismatch(src, tgt, chars = '()[]?!:"“”{}'):
     """
     Removes lines when the sum of certain characters between source and target is not the same.
@@ -103,6 +137,13 @@ def characters_count_mismatch(src, tgt, chars = '()[]?!:"“”{}'):
             return True
     return False
 
+def _characters_count_mismatch_batch(p, chars = '()[]?!:"“”{}'):
+    mask = p.none()
+    for ch in chars:
+        mask |= p.src.count_of(ch) != p.tgt.count_of(ch)
+    return mask
+characters_count_mismatch.batch = _characters_count_mismatch_batch
+
 def first_char_mismatch(src, tgt):
     """
     Removes lines when the first character is a letter but the case is mismatched, or the first character in source is not the same as the first character in target.
@@ -135,4 +176,35 @@ def limit_latin_chars(src, tgt, s_chset, t_chset, max = 12):
     elif t_chset != "Latn":
         return latin_char_count(tgt) > max
     else:
-        return False
\ No newline at end of file
+        return False
+
+def _limit_latin_chars_batch(p, s_chset, t_chset, max = 12):
+    if s_chset != "Latn":
+        return p.src.latin > max
+    elif t_chset != "Latn":
+        return p.tgt.latin > max
+    else:
+        return p.none()
+limit_latin_chars.batch = _limit_latin_chars_batch
+
+def near_duplicates(src, tgt, threshold = 0.8, memory = 256):
+    """
+    Removes lines that are near-duplicates of lines seen before during the merge (e.g. same sentence with different punctuation, numbers or casing),
+    using MinHash signatures and an LSH index shared by all sources
+
+    :param float threshold: Estimated similarity above which lines are considered near-duplicates (0.8)
+    :param int memory: Memory used by the LSH index, in megabytes (256)
+    """
+    from minhash import get_index
+    return bool(get_index(threshold, memory).check([src], [tgt])[0])
+
+def _near_duplicates_batch(p, threshold = 0.8, memory = 256):
+    from minhash import get_index
+    return get_index(threshold, memory).check(p.src.lines, p.tgt.lines, p.keep)
+near_duplicates.batch = _near_duplicates_batch
+
+def _near_duplicates_reset(threshold = 0.8, memory = 256):
+    from minhash import reset_index
+    reset_index(threshold, memory)
+near_duplicates.reset = _near_duplicates_reset
+near_duplicates.stateful = True
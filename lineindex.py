@@ -0,0 +1,102 @@
+import os
+import struct
+import hashlib
+import numpy as np
+from readers import byte_range
+
+MAGIC = b"LOCOLIDX"
+HEADER = struct.Struct("<8sQQQ") # magic, file size, file mtime (ns), newline count
+
+def _index_file(file, index_dir=None):
+    # Never stored next to the file, so that dataset folders aren't written to
+    if index_dir is None:
+        index_dir = os.path.join(os.path.dirname(__file__), "cache", "index")
+    os.makedirs(index_dir, exist_ok=True)
+    return os.path.join(index_dir, hashlib.md5(os.path.abspath(file).encode('utf-8')).hexdigest() + ".lidx")
+
+def build_index(file, index_file, start=0, end=None, block_size=64 * 1024 * 1024):
+    st = os.stat(file)
+    if end is None:
+        end = st.st_size
+    newlines = 0
+    tmp_file = index_file + ".tmp"
+
+    with open(file, "rb") as f, \
+         open(tmp_file, "wb") as out:
+        out.write(HEADER.pack(MAGIC, 0, 0, 0))
+        out.write(np.array([start], dtype=np.uint64).tobytes())
+
+        f.seek(start)
+        pos = start
+        last_end = start
+        while pos < end:
+            chunk = f.read(min(block_size, end - pos))
+            if not chunk:
+                break
+            ends = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10).astype(np.uint64) + (pos + 1)
+            out.write(ends.tobytes())
+            newlines += len(ends)
+            pos += len(chunk)
+            if len(ends) > 0:
+                last_end = int(ends[-1])
+
+        # Last line without a trailing newline
+        if pos > last_end:
+            out.write(np.array([pos], dtype=np.uint64).tobytes())
+
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, st.st_size, st.st_mtime_ns, newlines))
+
+    os.replace(tmp_file, index_file)
+
+class LineIndex:
+    """Byte offsets of every line in a text file, built once with a fast
+    bytes-level pass and cached on disk. offsets[i] is where line i begins,
+    offsets[len(index)] is the end of the file. For members stored in an
+    archive, offsets are positions in the archive (self.data_file).
+    The index is stored in index_dir (default: cache/index)."""
+
+    def __init__(self, file, index_dir=None):
+        self.file = file
+        self.data_file, start, end = byte_range(file)
+        self.index_file = _index_file(file, index_dir)
+
+        if not self._load():
+            build_index(self.data_file, self.index_file, start, end)
+            if not self._load():
+                raise Exception(f"Cannot build line index for {file}")
+
+    def _load(self):
+        if not os.path.isfile(self.index_file):
+            return False
+
+        st = os.stat(self.data_file)
+        with open(self.index_file, "rb") as f:
+            header = f.read(HEADER.size)
+        if len(header) != HEADER.size:
+            return False
+        magic, size, mtime, newlines = HEADER.unpack(header)
+        if magic != MAGIC or size != st.st_size or mtime != st.st_mtime_ns:
+            return False
+
+        self.newlines = newlines
+        self.offsets = np.memmap(self.index_file, dtype=np.uint64, mode='r', offset=HEADER.size)
+        return True
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def offset(self, line):
+        """Byte offset where line begins (the file size past the last line)"""
+        return int(self.offsets[min(max(line, 0), len(self))])
+
+    def line_at(self, offset):
+        """Number of the line containing byte offset"""
+        return int(np.searchsorted(self.offsets, offset, side='right')) - 1
+
+    def read_line(self, mm, line):
+        return mm[self.offset(line):self.offset(line + 1)]
+
+    def sample(self, k, rng):
+        """Random line numbers (sorted), without replacement"""
+        return sorted(rng.sample(range(len(self)), min(k, len(self))))
@@ -0,0 +1,182 @@
+import threading
+import numpy as np
+
+NUM_PERM = 64 # Must be a power of two
+SHINGLE_SIZE = 4 # At most 4
+
+_fold_table = None
+
+def fold_table():
+    """Lowercase letter for every unicode code point, 0 for anything else"""
+    global _fold_table
+    if _fold_table is None:
+        chars = np.arange(0x110000, dtype=np.uint32).view('<U1')
+        table = np.char.lower(chars).view(np.uint32).copy()
+        table[~np.char.isalpha(chars)] = 0
+        _fold_table = table
+    return _fold_table
+
+_MULTIPLIERS = np.array([0x9e3779b97f4a7c15, 0xc2b2ae3d27d4eb4f, 0x165667b19e3779f9, 0xd6e8feb86659fd93], dtype=np.uint64)
+_SIDE = np.uint64(0x27d4eb2f165667c5)
+
+def _mix(h):
+    # splitmix64 finalizer
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+def normalize(texts):
+    """Code points of texts lowercased, with anything other than letters (digits,
+    punctuation, spaces) collapsed to single spaces, and the length of each"""
+    lens = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    codes = fold_table()[np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32)]
+    owner = np.repeat(np.arange(len(texts)), lens)
+
+    letter = codes != 0
+    if len(codes) == 0:
+        return codes, lens
+
+    # Letters left in the same text, at or after each position
+    letters = np.cumsum(letter)
+    ends = np.cumsum(lens)
+    letters_after = letters[np.maximum(ends - 1, 0)][owner] - letters + letter
+
+    # Keep letters, and the first space of a run when it is between two letters
+    prev_letter = np.zeros(len(codes), dtype=bool)
+    prev_letter[1:] = letter[:-1] & (owner[1:] == owner[:-1])
+    keep = letter | (prev_letter & (letters_after > 0))
+
+    return np.where(letter, codes, ord(" "))[keep].astype(np.uint32), np.bincount(owner[keep], minlength=len(texts))
+
+def shingle_hashes(src_lines, tgt_lines, seed=0):
+    """Hashes of the character shingles of normalized line pairs, and the index of the pair each belongs to"""
+    texts = [t for pair in zip(src_lines, tgt_lines) for t in pair]
+    codes, lens = normalize(texts)
+    starts = np.cumsum(lens) - lens
+    owner = np.repeat(np.arange(len(texts)), lens)
+    ends = np.repeat(starts + lens, lens)
+    pos = np.arange(len(codes))
+    codes = np.concatenate((codes, np.zeros(SHINGLE_SIZE, dtype=codes.dtype))).astype(np.uint64)
+
+    # Source and target shingles are hashed differently
+    h = (owner & 1).astype(np.uint64) * _SIDE + np.uint64(seed)
+    for k in range(SHINGLE_SIZE):
+        c = codes[k:k + len(pos)]
+        h += np.where(pos + k < ends, c, 0) * _MULTIPLIERS[k]
+    h = _mix(h)
+
+    # Texts shorter than a shingle count as a single shingle
+    valid = (pos + SHINGLE_SIZE <= ends) | ((pos == starts[owner]) & (lens[owner] < SHINGLE_SIZE))
+    return h[valid], owner[valid] // 2
+
+def lsh_params(threshold, num_perm=NUM_PERM):
+    """Number of (bands, rows per band) such that two signatures with
+    similarity close to threshold have about even odds of sharing a band"""
+    best = None
+    for bands in range(1, num_perm + 1):
+        if num_perm % bands != 0:
+            continue
+        rows = num_perm // bands
+        t = (1.0 / bands) ** (1.0 / rows)
+        if best is None or abs(t - threshold) < abs(best[2] - threshold):
+            best = (bands, rows, t)
+    return best[0], best[1]
+
+class LSHIndex:
+    """Near-duplicate detector based on MinHash signatures of character
+    shingles and a banded LSH index. Each band is a fixed-size hash table
+    (memory bytes in total): colliding keys overwrite each other, so memory
+    stays bounded no matter how many lines are seen, at the cost of forgetting
+    some of them. Which copy of a near-duplicate pair is kept depends on the
+    order lines are checked in, so lines must be checked in a fixed order."""
+
+    def __init__(self, threshold=0.8, memory=256 * 1024 * 1024, num_perm=NUM_PERM, seed=1):
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        self.slots = max(1, memory // (8 * self.bands))
+
+        self.num_perm = num_perm
+        self.seed = seed
+        self.mix = np.random.default_rng(seed).integers(1, 2 ** 63, self.rows, dtype=np.uint64) | np.uint64(1)
+
+        self.table = np.zeros((self.bands, self.slots), dtype=np.uint64)
+        self.band_idx = np.arange(self.bands)
+        self.lock = threading.Lock()
+
+    def signatures(self, src_lines, tgt_lines):
+        # One permutation hashing: shingle hashes are split into num_perm bins
+        # by their top bits, and each bin keeps its minimum, which gives a MinHash
+        # signature in a single pass instead of one per permutation
+        h, owner = shingle_hashes(src_lines, tgt_lines, self.seed)
+        bits = self.num_perm.bit_length() - 1
+        empty = np.uint64(2 ** 64 - 1)
+        sigs = np.full(len(src_lines) * self.num_perm, empty, dtype=np.uint64)
+        np.minimum.at(sigs, owner * self.num_perm + (h >> np.uint64(64 - bits)).astype(np.int64), h & np.uint64(2 ** (64 - bits) - 1))
+        sigs = sigs.reshape(len(src_lines), self.num_perm)
+
+        # Empty bins (short texts) copy the value of a non-empty bin, picked by probing
+        # a pseudo-random sequence of bins that only depends on the empty bin (optimal densification)
+        filled = sigs != empty
+        rows, cols = np.nonzero(~filled & np.any(filled, axis=1)[:, None])
+        dense = sigs.copy()
+        attempt = 0
+        while len(rows) > 0:
+            probe = (_mix(cols.astype(np.uint64) * np.uint64(self.num_perm) + np.uint64(attempt) * np.uint64(self.num_perm ** 2)) % np.uint64(self.num_perm)).astype(np.int64)
+            found = filled[rows, probe]
+            dense[rows[found], cols[found]] = sigs[rows[found], probe[found]]
+            rows = rows[~found]
+            cols = cols[~found]
+            attempt += 1
+
+        return dense
+
+    def band_keys(self, src_lines, tgt_lines):
+        sigs = self.signatures(src_lines, tgt_lines).reshape(len(src_lines), self.bands, self.rows)
+        # 0 marks empty slots
+        return (sigs * self.mix).sum(axis=2, dtype=np.uint64) | np.uint64(1)
+
+    def check(self, src_lines, tgt_lines, mask=None):
+        """Returns a mask of the line pairs that are near-duplicates of pairs seen
+        before (or earlier in the batch), and adds the others to the index.
+        Only pairs selected by mask are considered."""
+        dups = np.zeros(len(src_lines), dtype=bool)
+        rows = np.flatnonzero(mask) if mask is not None else np.arange(len(src_lines))
+        if len(rows) == 0:
+            return dups
+
+        if len(rows) < len(src_lines):
+            src_lines = [src_lines[i] for i in rows.tolist()]
+            tgt_lines = [tgt_lines[i] for i in rows.tolist()]
+        keys = self.band_keys(src_lines, tgt_lines)
+        slots = (keys % np.uint64(self.slots)).astype(np.int64)
+
+        # Pairs sharing a band with an indexed pair, or with an earlier pair of the batch
+        found = np.zeros(len(rows), dtype=bool)
+        for band in range(self.bands):
+            _, first = np.unique(keys[:, band], return_index=True)
+            repeated = np.ones(len(rows), dtype=bool)
+            repeated[first] = False
+            found |= repeated
+
+        with self.lock:
+            found |= np.any(self.table[self.band_idx, slots] == keys, axis=1)
+            new = ~found
+            self.table[self.band_idx, slots[new]] = keys[new]
+
+        dups[rows] = found
+        return dups
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_index(threshold, memory):
+    """LSH index shared by all filters using the same settings (memory in MB)"""
+    with _indexes_lock:
+        k = (threshold, memory)
+        if not k in _indexes:
+            _indexes[k] = LSHIndex(threshold, int(memory * 1024 * 1024))
+        return _indexes[k]
+
+def reset_index(threshold, memory):
+    """Forget the lines seen by the index with these settings"""
+    with _indexes_lock:
+        _indexes.pop((threshold, memory), None)
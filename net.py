@@ -25,6 +25,42 @@ class AtomicCounter:
             return self.value
 
 
+class MultiProgress:
+    """Single progress line for several concurrent downloads"""
+
+    def __init__(self, total, interval=0.5):
+        self.total = total
+        self.interval = interval
+        self.completed = 0
+        self.active = {}
+        self.last_print = 0
+        self.width = 0
+        self.lock = threading.Lock()
+
+    def callback(self, name):
+        return lambda progress: self.update(name, progress)
+
+    def update(self, name, progress):
+        with self.lock:
+            self.active[name] = progress
+            if time.time() - self.last_print >= self.interval:
+                self._print()
+
+    def finish(self, name):
+        with self.lock:
+            self.active.pop(name, None)
+            self.completed += 1
+            self._print()
+
+    def _print(self):
+        self.last_print = time.time()
+        line = f"Fetched {self.completed}/{self.total}"
+        if len(self.active) > 0:
+            line += " | " + " ".join([f"{n} [{int(p)}%]" for n, p in self.active.items()])
+        print("\r" + line.ljust(self.width), end="\n" if self.completed == self.total else "\r", flush=True)
+        self.width = len(line)
+
+
 class NetError(Exception):
     pass
 
@@ -1,43 +1,75 @@
+import os
 import torch
 import sys
 import math
+import json
+from concurrent.futures import ThreadPoolExecutor
 from onmt.constants import DefaultTokens
 from onmt.transforms import register_transform
+from onmt.transforms.transform import Transform
 
 # From: https://github.com/OpenNMT/OpenNMT-py
 # MIT licensed
 # Copyright (c) 2017-Present OpenNMT
 
+def load_checkpoint(model_file):
+    # Ask the OS to start reading the file in the background
+    if hasattr(os, "posix_fadvise"):
+        fd = os.open(model_file, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    try:
+        # Tensors are paged in from disk as they are read
+        return torch.load(model_file, map_location='cpu', mmap=True)
+    except RuntimeError:
+        # Checkpoints in the legacy (non zip) format cannot be memory-mapped
+        return torch.load(model_file, map_location='cpu')
+
 def average_models(model_files, output, fp32=False):
+    """Average the weights of model_files. Checkpoints are memory-mapped and summed
+    one at a time into fp32 tensors (the next checkpoint is opened while the current
+    one is summed), so memory stays at about two models however many are averaged."""
     vocab = None
     opt = None
-    avg_model = None
-    avg_generator = None
-
-    for i, model_file in enumerate(model_files):
-        m = torch.load(model_file, map_location='cpu')
-        model_weights = m['model']
-        generator_weights = m['generator']
-
-        if fp32:
-            for k, v in model_weights.items():
-                model_weights[k] = v.float()
-            for k, v in generator_weights.items():
-                generator_weights[k] = v.float()
-
-        if i == 0:
-            vocab, opt = m['vocab'], m['opt']
-            avg_model = model_weights
-            avg_generator = generator_weights
-        else:
-            for (k, v) in avg_model.items():
-                avg_model[k].mul_(i).add_(model_weights[k]).div_(i + 1)
-
-            for (k, v) in avg_generator.items():
-                avg_generator[k].mul_(i).add_(generator_weights[k]).div_(i + 1)
+    sums = {'model': None, 'generator': None}
+    dtypes = {'model': {}, 'generator': {}}
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_checkpoint = executor.submit(load_checkpoint, model_files[0])
+        for i in range(len(model_files)):
+            m = next_checkpoint.result()
+            if i + 1 < len(model_files):
+                next_checkpoint = executor.submit(load_checkpoint, model_files[i + 1])
+
+            if i == 0:
+                vocab, opt = m['vocab'], m['opt']
+
+            for part in ['model', 'generator']:
+                weights = m[part]
+                if i == 0:
+                    sums[part] = {}
+                    for k, v in weights.items():
+                        dtypes[part][k] = v.dtype
+                        # Copy, so that the mapped file is never written to
+                        sums[part][k] = v.to(dtype=torch.float32, copy=True) if v.is_floating_point() else v.clone()
+                else:
+                    for k, v in sums[part].items():
+                        if v.is_floating_point():
+                            v.add_(weights[k])
+            del m, weights
+
+    for part in ['model', 'generator']:
+        for k, v in sums[part].items():
+            if v.is_floating_point():
+                v.div_(len(model_files))
+                if not fp32:
+                    sums[part][k] = v.to(dtypes[part][k])
 
     final = {"vocab": vocab, "opt": opt, "optim": None,
-             "generator": avg_generator, "model": avg_model}
+             "generator": sums['generator'], "model": sums['model']}
     
     torch.save(final, output)
 
@@ -62,3 +94,70 @@ def sp_vocab_to_onmt_vocab(sp_vocab, onmt_vocab):
                     print(str(e))
 
     print(f"Wrote {onmt_vocab}")
+
+
+@register_transform(name='locomotive')
+class LocomotiveTransform(Transform):
+    """Locomotive filters and transforms, applied to the examples of weighted
+    sources as OpenNMT's data loader reads them"""
+
+    def __init__(self, opts):
+        super().__init__(opts)
+
+    @classmethod
+    def add_options(cls, parser):
+        group = parser.add_argument_group("Transform/Locomotive")
+        group.add("--locomotive_config", "-locomotive_config", type=str, default=None,
+                  help="JSON file with the filters and transforms of each corpus")
+
+    def _parse_opts(self):
+        self.config_file = self.opts.locomotive_config
+        self.chains = None
+
+    def _load_chains(self):
+        from data import get_funcs
+        import filters as filter_funcs
+        import transforms as transform_funcs
+
+        with open(self.config_file, "r", encoding="utf-8") as f:
+            corpora = json.loads(f.read())
+        self.chains = {}
+        for cid, c in corpora.items():
+            self.chains[cid] = (get_funcs(filter_funcs, c.get('filters', [])), get_funcs(transform_funcs, c.get('transforms', [])))
+
+    def __getstate__(self):
+        # Data loader workers are spawned, and rebuild the chains on first use
+        state = dict(self.__dict__)
+        state['chains'] = None
+        return state
+
+    def apply(self, example, is_train=False, stats=None, **kwargs):
+        if self.chains is None:
+            self._load_chains()
+        chain = self.chains.get(example.get('cid'))
+        if chain is None:
+            return example
+        filters, transforms = chain
+
+        src = " ".join(example['src'])
+        tgt = " ".join(example['tgt'])
+        for f in filters:
+            if f(src, tgt):
+                return None
+        for t in transforms:
+            src, tgt = t(src, tgt)
+        if src.strip() == "" or tgt.strip() == "":
+            return None
+
+        example['src'] = src.strip().split(" ")
+        example['tgt'] = tgt.strip().split(" ")
+        return example
+
+    def _repr_args(self):
+        return f"locomotive_config={self.config_file}"
+
+
+if __name__ == "__main__":
+    # onmt_train, with the locomotive transform registered
+    from onmt.bin.train import main
+    main()
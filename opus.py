@@ -2,9 +2,19 @@ import requests
 import datetime
 import json
 import os
+import threading
 
 API_BASE = "https://opus.nlpl.eu/opusapi/"
 
+# Sources are resolved concurrently
+cache_lock = threading.Lock()
+
+def read_cache(opus_cache):
+    if os.path.isfile(opus_cache):
+        with open(opus_cache, "r", encoding="utf-8") as f:
+            return json.loads(f.read())
+    return {}
+
 def opus_datasets():
     r = requests.get(f"{API_BASE}?corpora=True")
     if r.status_code != 200:
@@ -16,10 +26,8 @@ def get_opus_dataset_url(corpora, from_code, to_code, run_dir):
     current_dir = os.path.dirname(__file__)
     opus_cache = os.path.join(run_dir, "opus_cache.json")
 
-    cache = {}
-    if os.path.isfile(opus_cache):
-        with open(opus_cache, "r", encoding="utf-8") as f:
-            cache = json.loads(f.read())
+    with cache_lock:
+        cache = read_cache(opus_cache)
     
     key = f"{corpora}-{from_code}-{to_code}"
     if key in cache:
@@ -38,10 +46,12 @@ def get_opus_dataset_url(corpora, from_code, to_code, run_dir):
         print(f"WARN: Multiple corpora found for {corpora} ({from_code}-{to_code}), using first")
     
     url = res["corpora"][0]["url"]
-    cache[key] = url
 
-    with open(opus_cache, "w", encoding="utf-8") as f:
-        f.write(json.dumps(cache))
+    with cache_lock:
+        cache = read_cache(opus_cache)
+        cache[key] = url
+        with open(opus_cache, "w", encoding="utf-8") as f:
+            f.write(json.dumps(cache))
 
     return url
 
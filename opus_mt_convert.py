@@ -10,8 +10,13 @@ import re
 import shutil
 import glob
 import stanza
-import subprocess
+import ctranslate2
 from net import download
+from package import write_package, folder_members
+from benchmark import quantization_sweep
+from vmap import build_vmap
+from data import get_flores
+from tokenizer import SentencePieceTokenizer, BPETokenizer
 import requests
 import iso639
 
@@ -40,13 +45,37 @@ parser.add_argument('--model-url',
     help='URL to OPUS model: %(default)s')
 parser.add_argument('-q', '--quantization',
     type=str,
-    choices=["int8", "float32"],
-    default="int8",
-    help='Quantization: %(default)s')
+    nargs="+",
+    choices=["int8", "int8_float32", "int16", "float32"],
+    default=["int8"],
+    help='Quantization. With more than one, each is benchmarked and the fastest within --bleu-tolerance is kept: %(default)s')
+parser.add_argument('--bleu-tolerance',
+    type=float,
+    default=1.0,
+    help='BLEU points a quantization may lose compared to float32 (or the best quantization) to be kept: %(default)s')
+parser.add_argument('--benchmark-sentences',
+    type=int,
+    default=500,
+    help='Number of flores200 sentences used to benchmark quantizations: %(default)s')
+parser.add_argument('--vmap-corpus',
+    type=str,
+    nargs=2,
+    metavar=("SOURCE", "TARGET"),
+    default=None,
+    help='Parallel source and target text files to build a vocabulary map (vmap) from: %(default)s')
+parser.add_argument('--vmap-sentences',
+    type=int,
+    default=1000000,
+    help='Maximum number of sentences of --vmap-corpus to read: %(default)s')
 parser.add_argument('--bos',
     type=str,
     default="",
     help='Set beginning of sentence token in model configuration: %(default)s')
+parser.add_argument('--compression-level',
+    type=int,
+    choices=range(0, 10),
+    default=0,
+    help='Deflate level of the package, 0 to store files uncompressed: %(default)s')
 args = parser.parse_args()
 
 def lang_name_from_code(code):
@@ -137,6 +166,10 @@ if sp_model is None and bpe_model is None:
     print("Cannot find SentencePiece/BPE source model")
     exit(1)
 
+# The target side can have its own vocabulary (used for the vmap)
+tgt_sp_model = next((m for m in spm_models if "target" in os.path.basename(m).lower()), None)
+tgt_bpe_model = next((m for m in bpe_models if "target" in os.path.basename(m).lower()), None)
+
 npz_models = glob.glob(os.path.join(model_path, "*.npz"))
 npz_model = None
 
@@ -240,36 +273,62 @@ if remapped:
 
 # Quantize
 ct2_model_dir = os.path.join(run_dir, "model")
-if os.path.isdir(ct2_model_dir):
-    shutil.rmtree(ct2_model_dir)
-
-print(f"Converting to ctranslate2 using {args.quantization}")
-subprocess.run([
-        "ct2-marian-converter",
-        "--model_path",
-        npz_model,
-        "--vocab_paths",
-        vocab_file,
-        "--output_dir",
-        ct2_model_dir,
-        "--quantization",
-        args.quantization])
-
-if args.bos:
-    ct2_model_config = os.path.join(ct2_model_dir, "config.json")
-    if not os.path.isfile(ct2_model_config):
-        print(f"Cannot find {ct2_model_config}")
-        exit(1)
+if sp_model_path is not None:
+    tokenizer = SentencePieceTokenizer(sp_model_path)
+else:
+    tokenizer = BPETokenizer(bpe_model_path, args.source, args.target)
 
-    model_conf = {}
-    with open(ct2_model_config, "r", encoding="utf-8") as f:
-        model_conf = json.loads(f.read())
-    model_conf['add_source_bos'] = True
-    model_conf['bos_token'] = args.bos
+def convert_model(output_dir, quantization):
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    ctranslate2.converters.MarianConverter(npz_model, [vocab_file]).convert(output_dir, quantization=quantization, force=True)
 
-    with open(ct2_model_config, "w", encoding="utf-8") as f:
-        f.write(json.dumps(model_conf, indent=4))
-    print(f"Wrote {ct2_model_config}")
+    if args.bos:
+        ct2_model_config = os.path.join(output_dir, "config.json")
+        if not os.path.isfile(ct2_model_config):
+            print(f"Cannot find {ct2_model_config}")
+            exit(1)
+
+        model_conf = {}
+        with open(ct2_model_config, "r", encoding="utf-8") as f:
+            model_conf = json.loads(f.read())
+        model_conf['add_source_bos'] = True
+        model_conf['bos_token'] = args.bos
+
+        with open(ct2_model_config, "w", encoding="utf-8") as f:
+            f.write(json.dumps(model_conf, indent=4))
+        print(f"Wrote {ct2_model_config}")
+
+if len(args.quantization) > 1:
+    # Some models break with int8: benchmark each quantization on flores200
+    # and keep the fastest one within tolerance
+    try:
+        src_text = get_flores(args.source)[:args.benchmark_sentences]
+        tgt_text = get_flores(args.target)[:args.benchmark_sentences]
+    except KeyError as e:
+        print(f"Cannot benchmark quantizations, no flores200 dataset for {e}")
+        exit(1)
+    best, report = quantization_sweep(convert_model, ct2_model_dir, args.quantization, tokenizer,
+                                      src_text, tgt_text, tolerance=args.bleu_tolerance)
+    with open(os.path.join(run_dir, "quantization-report.json"), "w", encoding="utf-8") as f:
+        f.write(json.dumps({'quantization': best, 'variants': report}, indent=4))
+else:
+    print(f"Converting to ctranslate2 using {args.quantization[0]}")
+    convert_model(ct2_model_dir, args.quantization[0])
+
+if args.vmap_corpus is not None:
+    vmap_file = os.path.join(ct2_model_dir, "vmap.txt")
+    if sp_model_path is not None and tgt_sp_model is not None:
+        tgt_tokenizer = SentencePieceTokenizer(tgt_sp_model)
+    elif sp_model_path is None and tgt_bpe_model is not None:
+        tgt_tokenizer = BPETokenizer(tgt_bpe_model, args.target, args.source)
+    else:
+        print("Cannot find a target SentencePiece/BPE model, using the source model for the target side")
+        tgt_tokenizer = tokenizer
+    mapped = build_vmap(lambda lines: [tokenizer.encode(l) for l in lines], args.vmap_corpus[0], args.vmap_corpus[1],
+                        vmap_file, max_sentences=args.vmap_sentences,
+                        encode_tgt=lambda lines: [tgt_tokenizer.encode(l) for l in lines])
+    print(f"Wrote {vmap_file} ({mapped} source tokens)")
 
 # Package
 readme = f"""# {src_lang_name} - {tgt_lang_name} version {version}
@@ -307,25 +366,10 @@ if os.path.isfile(package_file):
     os.unlink(package_file)
 
 print(f"Writing {package_file}")
-with zipfile.ZipFile(package_file, 'w', compression=zipfile.ZIP_STORED) as zipf:
-    def add_file(f):
-        zipf.write(f, arcname=os.path.join(zip_base, os.path.basename(f)))
-
-    def add_folder(f):
-        for root, dirs, files in os.walk(f):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, f)
-                zipf.write(file_path, arcname=os.path.join(zip_base, os.path.basename(f), arcname))
-
-    add_file(readme_file)
-    add_file(metadata_file)
-    if sp_model_path is not None:
-        add_file(sp_model_path)
-    if bpe_model_path is not None:
-        add_file(bpe_model_path)
-    add_folder(ct2_model_dir)
-    add_folder(stanza_dir)
+members = [(os.path.join(zip_base, os.path.basename(f)), f) for f in [readme_file, metadata_file, sp_model_path, bpe_model_path] if f is not None]
+members += folder_members(ct2_model_dir, os.path.join(zip_base, "model"))
+members += folder_members(stanza_dir, os.path.join(zip_base, "stanza"))
+write_package(package_file, members, compresslevel=args.compression_level)
 
 # Write config file
 config = {
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import zlib
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+BUFFER_SIZE = 1024 * 1024
+
+# Members at least this big are compressed in parallel
+PARALLEL_MIN_SIZE = 4 * 1024 * 1024
+
+def folder_members(folder, arcname):
+    """(archive name, path) of all files in folder, stored under arcname"""
+    members = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            members.append((os.path.join(arcname, os.path.relpath(path, folder)), path))
+    return members
+
+def _deflate(path, out_file, compresslevel):
+    """Write the raw deflate stream of path to out_file. Returns (CRC, compressed size)"""
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    crc = 0
+    with open(path, "rb") as f, open(out_file, "wb") as out:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+            out.write(compressor.compress(chunk))
+        out.write(compressor.flush())
+    return crc, os.path.getsize(out_file)
+
+def _write_deflated(zipf, info, deflated_file):
+    # zipfile cannot write data that is already compressed, so the member is added
+    # the same way ZipFile.write does it: local header, data, then the entry that
+    # the central directory is written from on close
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+    info.header_offset = zipf.fp.tell()
+    zipf.fp.write(info.FileHeader(zip64))
+    with open(deflated_file, "rb") as f:
+        shutil.copyfileobj(f, zipf.fp, BUFFER_SIZE)
+    zipf.filelist.append(info)
+    zipf.NameToInfo[info.filename] = info
+    zipf.start_dir = zipf.fp.tell()
+
+def write_package(package_file, members, contents={}, compresslevel=0, max_workers=None):
+    """Write a .zip archive (e.g. an .argosmodel) straight from the files' original
+    locations. members is a list of (archive name, path) and contents maps archive
+    names to text (README, metadata), written first.
+    With compresslevel 0 files are stored. Otherwise large files are deflated
+    in parallel, while smaller ones are compressed as they are written."""
+    compression = zipfile.ZIP_STORED if compresslevel == 0 else zipfile.ZIP_DEFLATED
+    large = []
+    if compression == zipfile.ZIP_DEFLATED:
+        large = [path for arcname, path in members if os.path.getsize(path) >= PARALLEL_MIN_SIZE]
+
+    # Written to a temporary file, so that an interrupted run leaves no package behind
+    tmp_file = package_file + ".tmp"
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(package_file))) as tmp_dir, \
+         ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor, \
+         zipfile.ZipFile(tmp_file, "w", compression=compression, compresslevel=compresslevel or None) as zipf:
+        deflated = {}
+        for i, path in enumerate(large):
+            out_file = os.path.join(tmp_dir, f"{i}.deflate")
+            deflated[path] = (out_file, executor.submit(_deflate, path, out_file, compresslevel))
+
+        for arcname, text in contents.items():
+            zipf.writestr(arcname, text)
+
+        for arcname, path in members:
+            if path in deflated:
+                out_file, future = deflated[path]
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.CRC, info.compress_size = future.result()
+                _write_deflated(zipf, info, out_file)
+                os.unlink(out_file)
+            else:
+                zipf.write(path, arcname)
+
+    os.replace(tmp_file, package_file)
@@ -0,0 +1,48 @@
+import os
+import itertools
+import sentencepiece as spm
+
+def pretokenize(sp_model, src_file, tgt_file, src_out, tgt_out, src_seq_length=150, tgt_seq_length=150, num_threads=None, batch_size=100000):
+    """Encode a parallel corpus once with a SentencePiece model, writing the pieces
+    separated by spaces. Pairs that are empty or longer than src_seq_length/tgt_seq_length
+    pieces are dropped (as OpenNMT's filtertoolong transform would do).
+    Returns (kept, dropped)"""
+    sp = spm.SentencePieceProcessor(model_file=sp_model)
+    num_threads = num_threads or os.cpu_count() or 1
+    kept, dropped = 0, 0
+
+    # Write to temporary files, so that an interrupted run is never picked up.
+    # Lines only end with \n, a \r within a line must not split it
+    with open(src_file, "r", encoding="utf-8", newline="\n") as src_in, \
+         open(tgt_file, "r", encoding="utf-8", newline="\n") as tgt_in, \
+         open(src_out + ".tmp", "w", encoding="utf-8", newline="\n") as src_o, \
+         open(tgt_out + ".tmp", "w", encoding="utf-8", newline="\n") as tgt_o:
+        while True:
+            src_lines = [l.rstrip("\n") for l in itertools.islice(src_in, batch_size)]
+            tgt_lines = [l.rstrip("\n") for l in itertools.islice(tgt_in, batch_size)]
+            if len(src_lines) != len(tgt_lines):
+                raise Exception(f"{src_file} and {tgt_file} have a different number of lines")
+            if len(src_lines) == 0:
+                break
+
+            # Batches are encoded by SentencePiece's own thread pool
+            src_pieces = sp.encode(src_lines, out_type=str, num_threads=num_threads)
+            tgt_pieces = sp.encode(tgt_lines, out_type=str, num_threads=num_threads)
+
+            src_batch, tgt_batch = [], []
+            for s, t in zip(src_pieces, tgt_pieces):
+                # Room is left for BOS/EOS on the target side, as filtertoolong does
+                if len(s) == 0 or len(t) == 0 or len(s) > src_seq_length or len(t) > tgt_seq_length - 2:
+                    dropped += 1
+                    continue
+                src_batch.append(" ".join(s))
+                tgt_batch.append(" ".join(t))
+            kept += len(src_batch)
+
+            if len(src_batch) > 0:
+                src_o.write("\n".join(src_batch) + "\n")
+                tgt_o.write("\n".join(tgt_batch) + "\n")
+
+    os.replace(src_out + ".tmp", src_out)
+    os.replace(tgt_out + ".tmp", tgt_out)
+    return kept, dropped
@@ -0,0 +1,95 @@
+import json
+
+def new_profile():
+    return {
+        'time': 0.0,
+        'lines_read': 0,
+        'bytes_read': 0,
+        'filters': {},
+        'transforms': {},
+        'augmenters': {},
+        'writer': {'bytes': 0, 'batches': 0, 'time': 0.0, 'wait_time': 0.0, 'peak_queue_bytes': 0, 'peak_queue_batches': 0},
+    }
+
+def record(stages, name, elapsed, lines, **counters):
+    """Add a batch run of a filter, transform or augmenter to a profile"""
+    s = stages.setdefault(name, {'time': 0.0, 'calls': 0, 'lines': 0})
+    s['time'] += elapsed
+    s['calls'] += 1
+    s['lines'] += lines
+    for c, n in counters.items():
+        s[c] = s.get(c, 0) + n
+
+def merge_counters(into, other):
+    """Sum the counters of other into into (peaks are maxed)"""
+    for k, v in other.items():
+        if isinstance(v, dict):
+            merge_counters(into.setdefault(k, {}), v)
+        elif not isinstance(v, (int, float)):
+            into.setdefault(k, v)
+        elif k.startswith("peak_"):
+            into[k] = max(into.get(k, 0), v)
+        else:
+            into[k] = into.get(k, 0) + v
+    return into
+
+def rate(n, seconds):
+    return n / seconds if seconds > 0 else 0.0
+
+def source_summary(stats):
+    """Derived per source metrics: lines/sec, rejection rates and writer throughput"""
+    p = stats['profile']
+    summary = {
+        'time': p['time'],
+        'lines_read': p['lines_read'],
+        'bytes_read': p['bytes_read'],
+        'lines_per_sec': rate(p['lines_read'], p['time']),
+        'kept': stats['count'],
+        'augmented': stats['augmented'],
+        'writer_mb_per_sec': rate(p['writer']['bytes'], p['writer']['time']) / (1024 * 1024),
+        'peak_queue_bytes': p['writer']['peak_queue_bytes'],
+        'peak_queue_batches': p['writer']['peak_queue_batches'],
+        'filter_order': p.get('filter_order'),
+        'stages': {},
+    }
+    for kind in ['filters', 'transforms', 'augmenters']:
+        for name, s in p[kind].items():
+            st = dict(s)
+            st['lines_per_sec'] = rate(s['lines'], s['time'])
+            if 'rejected' in s:
+                st['rejection_rate'] = s['rejected'] / s['lines'] if s['lines'] > 0 else 0.0
+            summary['stages'][f"{kind[:-1]}:{name}"] = st
+    return summary
+
+def write_report(report, report_file):
+    with open(report_file, "w", encoding="utf-8") as f:
+        f.write(json.dumps(report, indent=2))
+
+def print_summary(report):
+    print("Merge profile")
+    print(f"{'source':<48} {'lines':>12} {'time (s)':>10} {'lines/s':>12} {'kept':>7}")
+    for k, s in report['sources'].items():
+        name = k if len(k) <= 48 else "..." + k[-45:]
+        kept = s['kept'] / s['lines_read'] if s['lines_read'] > 0 else 0.0
+        cached = " (cached)" if s.get('cached') else ""
+        print(f"{name:<48} {s['lines_read']:>12} {s['time']:>10.2f} {s['lines_per_sec']:>12.0f} {kept:>7.1%}{cached}")
+
+    # Totals over all the sources processed in this run
+    stages = {}
+    for s in report['sources'].values():
+        if not s.get('cached'):
+            merge_counters(stages, s['stages'])
+    total_time = sum(st['time'] for st in stages.values())
+
+    if len(stages) > 0:
+        print()
+        print(f"{'stage':<48} {'time (s)':>10} {'share':>7} {'lines/s':>12} {'rejected':>9}")
+        for name, st in sorted(stages.items(), key=lambda s: -s[1]['time']):
+            share = st['time'] / total_time if total_time > 0 else 0.0
+            rejected = f"{st['rejected'] / st['lines']:.1%}" if 'rejected' in st and st['lines'] > 0 else ""
+            print(f"{name:<48} {st['time']:>10.2f} {share:>7.1%} {rate(st['lines'], st['time']):>12.0f} {rejected:>9}")
+
+    print()
+    for step in ['process', 'concat', 'shuffle']:
+        print(f"{step}: {report['time'][step]:.2f}s")
+    print(f"Total: {report['time']['total']:.2f}s")
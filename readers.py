@@ -0,0 +1,178 @@
+import os
+import io
+import shutil
+import subprocess
+import itertools
+import struct
+import zipfile
+
+BUFFER_SIZE = 1024 * 1024
+
+def _threads():
+    return str(os.cpu_count() or 1)
+
+# Even single-threaded tools decompress in a separate process,
+# in parallel with the filters
+
+def _gzip_tools():
+    return [["pigz", "-dc", "-p", _threads()], ["gzip", "-dc"]]
+
+def _xz_tools():
+    # Multi-threaded decompression works on files compressed with multiple blocks (xz -T)
+    return [["xz", "-dc", "-T0"]]
+
+def _zstd_tools():
+    return [["zstd", "-dc", "-T0"]]
+
+def _bzip2_tools():
+    return [["lbzip2", "-dc", "-n", _threads()], ["pbzip2", "-dc", "-p" + _threads()], ["bzip2", "-dc"]]
+
+def _gzip_module(file):
+    import gzip
+    return gzip.open(file, "rb")
+
+def _xz_module(file):
+    import lzma
+    return lzma.open(file, "rb")
+
+def _zstd_module(file):
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception(f"Cannot read {file}: install zstd or the zstandard python module")
+    f = open(file, "rb") if isinstance(file, str) else file
+    return zstandard.ZstdDecompressor().stream_reader(f, read_size=BUFFER_SIZE, closefd=True)
+
+def _bzip2_module(file):
+    import bz2
+    return bz2.open(file, "rb")
+
+# extension: (external tools, in order of preference), python fallback
+CODECS = {
+    ".gz": (_gzip_tools, _gzip_module),
+    ".xz": (_xz_tools, _xz_module),
+    ".zst": (_zstd_tools, _zstd_module),
+    ".bz2": (_bzip2_tools, _bzip2_module),
+}
+
+# Members of .zip archives are addressed as archive.zip!/path/to/member
+ARCHIVE_SEPARATOR = "!/"
+
+def archive_member(file):
+    """(archive, member) if file points inside a .zip archive, otherwise None"""
+    if ARCHIVE_SEPARATOR in file:
+        archive, member = file.split(ARCHIVE_SEPARATOR, 1)
+        if os.path.isfile(archive):
+            return archive, member
+    return None
+
+def member_path(archive, member):
+    return archive + ARCHIVE_SEPARATOR + member
+
+def member_info(file):
+    archive, member = archive_member(file)
+    with zipfile.ZipFile(archive, "r") as z:
+        return z.getinfo(member)
+
+def compression(file):
+    """Compression extension of file (e.g. ".gz"), or None"""
+    ext = os.path.splitext(file)[1].lower()
+    return ext if ext in CODECS else None
+
+def is_compressed(file):
+    """Whether file can only be read sequentially (compressed files
+    and archive members that are not stored uncompressed)"""
+    if compression(file) is not None:
+        return True
+    if archive_member(file) is not None:
+        return member_info(file).compress_type != zipfile.ZIP_STORED
+    return False
+
+def strip_compression(file):
+    """File name without its compression extension (source.en.gz --> source.en)"""
+    return os.path.splitext(file)[0] if compression(file) is not None else file
+
+def byte_range(file):
+    """(path, start, end) of the bytes of a file that is not compressed. For members
+    stored in an archive, this is where the member's data is in the archive."""
+    m = archive_member(file)
+    if m is None:
+        return file, 0, os.path.getsize(file)
+
+    archive, member = m
+    info = member_info(file)
+    with open(archive, "rb") as f:
+        f.seek(info.header_offset)
+        header = f.read(30)
+    # The local header is followed by the file name and the extra field
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    start = info.header_offset + 30 + name_length + extra_length
+    return archive, start, start + info.file_size
+
+class ToolReader(io.RawIOBase):
+    """Reads the output of an external decompression tool"""
+
+    def __init__(self, cmd, file):
+        self.file = file
+        self.proc = subprocess.Popen(cmd + [file], stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.proc.stdout.readinto(b)
+        if n == 0 and self.proc.wait() != 0:
+            raise Exception(f"Cannot decompress {self.file}: {self.proc.stderr.read().decode('utf-8', errors='replace').strip()}")
+        return n
+
+    def close(self):
+        if not self.closed:
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc.wait()
+            self.proc.stdout.close()
+            self.proc.stderr.close()
+        super().close()
+
+def _open_member(file):
+    archive, member = archive_member(file)
+    # Decompress in a separate process if possible (unzip treats names as patterns)
+    if shutil.which("unzip") is not None and not any(c in member for c in "*?[]\\"):
+        return io.BufferedReader(ToolReader(["unzip", "-p", archive], member), buffer_size=BUFFER_SIZE)
+    # The archive file stays open until the member is closed
+    with zipfile.ZipFile(archive, "r") as z:
+        return io.BufferedReader(z.open(member, "r"), buffer_size=BUFFER_SIZE)
+
+def open_lines(file):
+    """Binary stream of a (possibly compressed) text file, or of a member of a .zip
+    archive. Compressed files are decompressed on the fly, with a multi-threaded
+    external tool if available"""
+    codec = compression(file)
+    if archive_member(file) is not None:
+        f = _open_member(file)
+        if codec is None:
+            return f
+        # Compressed file in an archive
+        return io.BufferedReader(CODECS[codec][1](f), buffer_size=BUFFER_SIZE)
+
+    if codec is None:
+        return open(file, "rb", buffering=BUFFER_SIZE)
+
+    tools, module = CODECS[codec]
+    for cmd in tools():
+        if shutil.which(cmd[0]) is not None:
+            return io.BufferedReader(ToolReader(cmd, file), buffer_size=BUFFER_SIZE)
+    return io.BufferedReader(module(file), buffer_size=BUFFER_SIZE)
+
+def count_lines(file):
+    """Number of newlines in a (possibly compressed) text file"""
+    count = 0
+    with open_lines(file) as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), b""):
+            count += chunk.count(b"\n")
+    return count
+
+def read_lines(file, first=0, last=None):
+    """Lines [first, last) of a (possibly compressed) text file, streamed"""
+    with open_lines(file) as f:
+        yield from itertools.islice(f, first, last)
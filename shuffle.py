@@ -0,0 +1,125 @@
+import os
+import math
+import shutil
+import tempfile
+import numpy as np
+
+# Approximate memory used by each line pair once loaded, besides its bytes
+# (two bytes objects, two list slots and a permutation entry)
+PAIR_OVERHEAD = 96
+
+def stratified_counts(counts, total):
+    """Split total among sources proportionally to counts (largest remainder)"""
+    counts = np.asarray(counts, dtype=np.int64)
+    if counts.sum() == 0:
+        return np.zeros(len(counts), dtype=np.int64)
+    quotas = counts * total / counts.sum()
+    out = np.floor(quotas).astype(np.int64)
+    for i in np.argsort(-(quotas - out), kind='stable')[:int(total - out.sum())]:
+        out[i] += 1
+    return np.minimum(out, counts)
+
+class ExternalShuffle:
+    """Shuffles line pairs that might not fit in memory. Pairs are assigned to
+    random partitions on disk as they are added, each sized to fit in max_memory
+    bytes, then each partition is loaded and shuffled in turn. The result only
+    depends on the pairs and on the seed."""
+
+    def __init__(self, expected_size, expected_lines, max_memory=1024 * 1024 * 1024, seed=0, tmp_dir=None):
+        estimate = expected_size + expected_lines * PAIR_OVERHEAD
+        # Leave some headroom, since partition sizes vary
+        self.partitions = max(1, math.ceil(estimate * 1.25 / max_memory))
+        self.seed = seed
+        self.rng = np.random.default_rng([seed, 0])
+        self.tmp_dir = tempfile.mkdtemp(prefix="shuffle-", dir=tmp_dir)
+        self.counts = {}
+
+        buffer_size = int(min(1024 * 1024, max(64 * 1024, max_memory // (8 * self.partitions))))
+        self.files = []
+        for p in range(self.partitions):
+            self.files.append(tuple(open(self._file(p, ext), "wb", buffering=buffer_size) for ext in [".src", ".tgt", ".ids"]))
+
+    def _file(self, p, ext):
+        return os.path.join(self.tmp_dir, f"part_{p}{ext}")
+
+    def add(self, src_lines, tgt_lines, source=0):
+        """Add line pairs (bytes, ending with a newline) from source (an int < 65536)"""
+        if len(src_lines) == 0:
+            return
+        self.counts[source] = self.counts.get(source, 0) + len(src_lines)
+
+        parts = self.rng.integers(0, self.partitions, len(src_lines))
+        order = np.argsort(parts, kind='stable')
+        bounds = np.searchsorted(parts[order], np.arange(self.partitions + 1))
+        ids = np.full(len(src_lines), source, dtype=np.uint16).tobytes()
+
+        for p in range(self.partitions):
+            if bounds[p] == bounds[p + 1]:
+                continue
+            rows = order[bounds[p]:bounds[p + 1]].tolist()
+            src_f, tgt_f, ids_f = self.files[p]
+            src_f.write(b"".join([src_lines[i] for i in rows]))
+            tgt_f.write(b"".join([tgt_lines[i] for i in rows]))
+            ids_f.write(ids[:len(rows) * 2])
+
+    def write(self, src_train, tgt_train, src_val, tgt_val, val_size=0, stratified=False, batch_size=100000):
+        """Write the shuffled pairs, setting aside val_size pairs for validation.
+        With stratified, each source contributes to the validation set in
+        proportion to its number of pairs, otherwise pairs are picked uniformly."""
+        for files in self.files:
+            for f in files:
+                f.close()
+
+        if stratified:
+            sources = sorted(self.counts.keys())
+            quotas = stratified_counts([self.counts[s] for s in sources], val_size)
+            val_left = np.zeros(max(sources) + 1 if len(sources) > 0 else 0, dtype=np.int64)
+            val_left[sources] = quotas
+        else:
+            val_left = val_size
+
+        with open(src_train, "wb") as src_tr, \
+             open(tgt_train, "wb") as tgt_tr, \
+             open(src_val, "wb") as src_v, \
+             open(tgt_val, "wb") as tgt_v:
+            for p in range(self.partitions):
+                with open(self._file(p, ".src"), "rb") as f:
+                    src_lines = f.read().split(b"\n")[:-1]
+                with open(self._file(p, ".tgt"), "rb") as f:
+                    tgt_lines = f.read().split(b"\n")[:-1]
+                ids = np.fromfile(self._file(p, ".ids"), dtype=np.uint16)
+
+                perm = np.random.default_rng([self.seed, p + 1]).permutation(len(src_lines))
+                ids = ids[perm]
+
+                # Since the order is random, the first pairs of the shuffled
+                # stream (of each source, if stratified) make a uniform sample
+                val = np.zeros(len(perm), dtype=bool)
+                if stratified:
+                    for s in np.flatnonzero(val_left).tolist():
+                        rows = np.flatnonzero(ids == s)[:val_left[s]]
+                        val[rows] = True
+                        val_left[s] -= len(rows)
+                else:
+                    n = min(val_left, len(perm))
+                    val[:n] = True
+                    val_left -= n
+
+                for rows, src_out, tgt_out in [(perm[val], src_v, tgt_v), (perm[~val], src_tr, tgt_tr)]:
+                    for i in range(0, len(rows), batch_size):
+                        batch = rows[i:i + batch_size].tolist()
+                        src_out.write(b"\n".join([src_lines[j] for j in batch]) + b"\n")
+                        tgt_out.write(b"\n".join([tgt_lines[j] for j in batch]) + b"\n")
+
+                del src_lines, tgt_lines
+
+                for ext in [".src", ".tgt", ".ids"]:
+                    os.unlink(self._file(p, ext))
+
+        self.close()
+
+    def close(self):
+        for files in self.files:
+            for f in files:
+                f.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
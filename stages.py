@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import hashlib
+
+def stage_key(upstream=[], **inputs):
+    """Hash of the inputs of a stage (config values, file fingerprints) and of the
+    keys of the stages it depends on. None if an upstream key is unknown, which
+    happens in dry runs when an upstream stage would run."""
+    if any(k is None for k in upstream):
+        return None
+    return hashlib.md5(json.dumps({'upstream': list(upstream), 'inputs': inputs}, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class Manifest:
+    """Key and outputs of each stage of the pipeline, saved in manifest.json.
+    A stage is skipped when its key matches the one of its last complete run
+    and its outputs still exist. In dry runs stages are reported, but never run."""
+
+    def __init__(self, run_dir, dry_run=False, fresh=False):
+        self.file = os.path.join(run_dir, "manifest.json")
+        self.dry_run = dry_run
+        self.stages = {}
+        self.plan = []
+        if not fresh and os.path.isfile(self.file):
+            with open(self.file, "r", encoding="utf-8") as f:
+                self.stages = json.loads(f.read())
+
+    def _save(self):
+        if self.dry_run:
+            return
+        with open(self.file + ".tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps(self.stages, indent=4))
+        os.replace(self.file + ".tmp", self.file)
+
+    def is_current(self, stage, key):
+        s = self.stages.get(stage)
+        return key is not None and s is not None and s['key'] == key and s['complete'] and \
+               all(os.path.exists(o) for o in s['outputs'])
+
+    def previous(self, stage):
+        """Record of the last run of stage, complete or not"""
+        return self.stages.get(stage, {})
+
+    def output_key(self, stage, key):
+        """Key to derive the keys of downstream stages from, when they also depend
+        on outputs of stage that are only known once it ran (unknown in dry runs)"""
+        if self.dry_run and any(s == stage and run for s, run in self.plan):
+            return None
+        return key
+
+    def report(self, stage, run, reason=""):
+        self.plan.append((stage, run))
+        status = ("would run" if self.dry_run else "running") if run else "up to date"
+        print(f"[{stage}] {status}{f' ({reason})' if reason else ''}")
+
+    def should_run(self, stage, key, force=False):
+        """Whether stage must run. Always False in dry runs"""
+        if force:
+            run, reason = True, "forced"
+        elif key is None:
+            run, reason = True, "upstream stages would run"
+        elif self.stages.get(stage) is None:
+            run, reason = True, "no previous run"
+        elif self.stages[stage]['key'] != key:
+            run, reason = True, "inputs changed"
+        elif not self.is_current(stage, key):
+            run, reason = True, "incomplete or missing outputs"
+        else:
+            run, reason = False, ""
+
+        self.report(stage, run, reason)
+        return run and not self.dry_run
+
+    def start(self, stage, key, **info):
+        self.stages[stage] = {'key': key, 'outputs': [], 'complete': False, 'time': time.time(), **info}
+        self._save()
+
+    def done(self, stage, key, outputs=[], **info):
+        self.stages[stage] = {'key': key, 'outputs': list(outputs), 'complete': True, 'time': time.time(), **info}
+        self._save()
+
+    def summary(self):
+        stages = [s for s, run in self.plan if run]
+        if len(stages) > 0:
+            print(f"Dry run: {len(stages)} stage(s) would run: {', '.join(stages)}")
+        else:
+            print("Dry run: everything is up to date")
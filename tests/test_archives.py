@@ -0,0 +1,21 @@
+import os
+import sys
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from data import open_pairs
+from readers import byte_range, member_path
+
+def test_stored_member_without_trailing_newline(tmp_path):
+    archive = os.path.join(tmp_path, "data.zip")
+    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_STORED) as z:
+        z.writestr("source.txt", "first\nlast source")
+        z.writestr("target.txt", "premier\nlast target")
+        z.writestr("README", b"\xff\xfe not utf-8")
+
+    source = member_path(archive, "source.txt")
+    target = member_path(archive, "target.txt")
+    shard = ("bytes", byte_range(source)[1:], byte_range(target)[1:])
+    with open_pairs(source, target, [shard]) as pairs:
+        assert list(pairs) == [(b"first\n", b"premier\n"), (b"last source", b"last target")]
@@ -0,0 +1,72 @@
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import filters as filter_funcs
+from data import get_funcs, filter_lines, new_stats
+from filterorder import FilterOrder
+
+SPECS = [
+    "first_char_mismatch",
+    {"digits_ratio": {"max": 0.2}},
+    {"nonalphanum_ratio": {"max": 0.2}},
+    {"source_target_ratio": {"min": 0.5, "max": 2}},
+    {"char_length": {"min": 20}},
+]
+
+class ReversedOrder(FilterOrder):
+    """Runs the chain in reverse config order from the first batch"""
+    def __init__(self, filters):
+        super().__init__(filters)
+        self.order = list(reversed(self.order))
+
+    def batch_done(self):
+        return False
+
+def make_pairs(count=5000, seed=0):
+    rnd = random.Random(seed)
+    def line():
+        chars = rnd.choice(["abcdefgh ", "Abcdefgh 12!", "abc 0123456789?,"])
+        return "".join(rnd.choice(chars) for _ in range(rnd.randint(5, 60)))
+    return [(line().encode("utf-8"), line().encode("utf-8")) for _ in range(count)]
+
+def make_filters():
+    """SPECS, after a slow filter that rejects few lines"""
+    calls = [0]
+    def expensive(src, tgt):
+        calls[0] += 1
+        return sum(ord(c) for c in src * 20) % 50 == 0
+    return [expensive] + get_funcs(filter_funcs, SPECS), calls
+
+def run(pairs, make_order):
+    filters, calls = make_filters()
+    stats = new_stats()
+    order = make_order(filters) if make_order is not None else None
+    kept = list(filter_lines(pairs, filters, [], [], stats, order, batch_size=500))
+    return kept, stats, calls[0]
+
+def test_per_source_totals_dont_depend_on_order():
+    pairs = make_pairs()
+    kept, stats, _ = run(pairs, None)
+    assert 0 < len(kept) < len(pairs)
+
+    for make_order in [ReversedOrder, lambda f: FilterOrder(f, warmup=1, recheck=1)]:
+        o_kept, o_stats, _ = run(pairs, make_order)
+        assert o_kept == kept
+        assert o_stats['count'] == stats['count']
+        assert sum(o_stats['filtered'].values()) == sum(stats['filtered'].values())
+
+def test_adaptive_order_runs_expensive_filter_on_fewer_lines():
+    pairs = make_pairs()
+    _, _, config_calls = run(pairs, None)
+    _, stats, adaptive_calls = run(pairs, lambda f: FilterOrder(f, warmup=1, recheck=1))
+    assert config_calls == len(pairs)
+    assert adaptive_calls < config_calls / 2
+    assert stats['profile']['filters']['expensive']['lines'] == adaptive_calls
+
+def test_reversed_order_runs_reversed():
+    filters, _ = make_filters()
+    order = ReversedOrder(filters)
+    assert order.names() == list(reversed([f.__name__ for f in filters]))
@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from data import merge_shuffle, has_stateful_filters
+
+WORDS = ["house", "river", "green", "table", "window", "garden", "bridge", "yellow", "market", "letter"]
+
+def write_source(path, seed, count=3000):
+    """Sentences from a small vocabulary, many of them repeated with different casing or punctuation"""
+    rnd = random.Random(seed)
+    base = [" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(4, 8))) for _ in range(count // 3)]
+    os.makedirs(path)
+    with open(os.path.join(path, "source.txt"), "w", encoding="utf-8") as src, \
+         open(os.path.join(path, "target.txt"), "w", encoding="utf-8") as tgt:
+        for _ in range(count):
+            s = rnd.choice(base)
+            if rnd.random() < 0.5:
+                s = s.capitalize() + rnd.choice([".", "!", "?"])
+            src.write(s + "\n")
+            tgt.write(s.upper() + "\n")
+
+def merge(sources, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    merge_shuffle(sources, out_dir, max_eval_sentences=100, processes=2)
+    outputs = {}
+    for f in ["src-train.txt", "tgt-train.txt", "src-val.txt", "tgt-val.txt"]:
+        with open(os.path.join(out_dir, f), "rb") as fp:
+            outputs[f] = fp.read()
+    cache_dir = os.path.join(out_dir, "merge-cache")
+    for f in sorted(os.listdir(cache_dir)):
+        if f.endswith(".json"):
+            with open(os.path.join(cache_dir, f), "r", encoding="utf-8") as fp:
+                stats = json.loads(fp.read())
+            outputs[f] = (stats['filtered'], stats['count'])
+    return outputs
+
+def make_sources(tmp_path):
+    sources = {}
+    for i, filters in enumerate([[{"near_duplicates": {"memory": 1}}],
+                                 [{"char_length": {"min": 10}}],
+                                 [{"near_duplicates": {"memory": 1}}]]):
+        path = os.path.join(tmp_path, f"ds{i}")
+        write_source(path, seed=i)
+        sources[f"file://{path}"] = {
+            'source': os.path.join(path, "source.txt"),
+            'target': os.path.join(path, "target.txt"),
+            'hash': str(i),
+            'filters': filters,
+            'transforms': [],
+            'augmenters': [],
+            'weight': None,
+        }
+    return sources
+
+def test_near_duplicates_merge_is_deterministic(tmp_path):
+    sources = make_sources(tmp_path)
+    first = merge(sources, os.path.join(tmp_path, "run1"))
+    second = merge(sources, os.path.join(tmp_path, "run2"))
+    assert first == second
+    assert any(stats[0].get('near_duplicates', 0) > 0 for f, stats in first.items() if f.endswith(".json"))
+
+def test_removing_a_stateful_source_reprocesses_the_others(tmp_path):
+    sources = make_sources(tmp_path)
+    out_dir = os.path.join(tmp_path, "run")
+    merge(sources, out_dir)
+
+    del sources[next(iter(sources))]
+    remerged = merge(sources, out_dir)
+    with open(os.path.join(out_dir, "merge-report.json"), "r", encoding="utf-8") as f:
+        report = json.loads(f.read())
+    cached = {k: report['sources'][k]['cached'] for k in sources}
+    assert cached == {k: not has_stateful_filters(sources[k]) for k in sources}
+
+    assert remerged == merge(sources, os.path.join(tmp_path, "fresh"))
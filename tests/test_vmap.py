@@ -0,0 +1,28 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from vmap import build_vmap
+
+def test_target_side_uses_target_vocabulary(tmp_path):
+    src_file = os.path.join(tmp_path, "source.txt")
+    tgt_file = os.path.join(tmp_path, "target.txt")
+    out_file = os.path.join(tmp_path, "vmap.txt")
+    with open(src_file, "w", encoding="utf-8") as f:
+        f.write("the house\nthe river\nred house\n" * 10)
+    with open(tgt_file, "w", encoding="utf-8") as f:
+        f.write("la casa\nel rio\ncasa roja\n" * 10)
+
+    # Pieces of each vocabulary are told apart by their prefix
+    src_encode = lambda lines: [["src_" + w for w in l.split()] for l in lines]
+    tgt_encode = lambda lines: [["tgt_" + w for w in l.split()] for l in lines]
+    mapped = build_vmap(src_encode, src_file, tgt_file, out_file, fixed_size=1, encode_tgt=tgt_encode)
+
+    with open(out_file, "r", encoding="utf-8") as f:
+        entries = [l.rstrip("\n").split("\t") for l in f]
+    assert mapped == len(entries) - 1
+    assert entries[0][0] == ""
+    for source, targets in entries:
+        assert source == "" or source.startswith("src_")
+        assert all(t.startswith("tgt_") for t in targets.split(" "))
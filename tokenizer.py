@@ -5,6 +5,9 @@ from typing import List
 class Tokenizer:
     def encode(self, sentence: str) -> List[str]:
         raise NotImplementedError()
+
+    def encode_batch(self, sentences: List[str], num_threads: int = 1) -> List[List[str]]:
+        return [self.encode(s) for s in sentences]
     
     def decode(self, tokens: List[str]) -> str:
         raise NotImplementedError()
@@ -23,6 +26,9 @@ class SentencePieceTokenizer(Tokenizer):
         tokens = self.lazy_processor().encode(sentence, out_type=str)
         return tokens
 
+    def encode_batch(self, sentences: List[str], num_threads: int = 1) -> List[List[str]]:
+        return self.lazy_processor().encode(sentences, out_type=str, num_threads=num_threads)
+
     def decode(self, tokens: List[str]) -> str:
         detokenized = "".join(tokens)
         return detokenized.replace("▁", " ")
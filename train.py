@@ -11,13 +11,28 @@ import yaml
 import subprocess
 import stanza
 import re
+import time
 import zipfile
 import ctranslate2
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from opus import get_opus_dataset_url
-from net import download
-from data import sources_changed, merge_shuffle, extract_flores_val
+from net import download, MultiProgress
+from data import merge_key, merge_shuffle, prepare_source, extract_flores_val, write_vocab_sample, get_funcs
+import filters as filter_funcs
+import transforms as transform_funcs
+from readers import is_compressed, strip_compression, member_path
+import archives
 import sentencepiece as spm
 from onmt_tools import average_models, sp_vocab_to_onmt_vocab
+from pretokenize import pretokenize
+from stages import Manifest, stage_key
+from package import write_package, folder_members
+from benchmark import quantization_sweep
+from vmap import build_vmap
+from batch_translate import fingerprint
+from tokenizer import SentencePieceTokenizer
 
 parser = argparse.ArgumentParser(description='Train LibreTranslate compatible models')
 parser.add_argument('--config',
@@ -39,6 +54,9 @@ parser.add_argument('--tensorboard',
 parser.add_argument('--toy',
     action='store_true',
     help='Train a toy model (useful for testing). Default: %(default)s')
+parser.add_argument('--dry-run',
+    action='store_true',
+    help='Show which stages of the pipeline would run, without running them. Default: %(default)s')
 parser.add_argument('--inflight',
     action='store_true',
     help='While training is in progress on a separate process, you can launch another instance of train.py with this flag turned on to build a model from the last available checkpoints rather that waiting until the end. Default: %(default)s')
@@ -77,17 +95,94 @@ rel_run_dir = f"run/{model_dirname}"
 rel_onmt_dir = f"{rel_run_dir}/opennmt"
 os.makedirs(cache_dir, exist_ok=True)
 
-if args.rerun and os.path.isdir(run_dir):
+if args.rerun and os.path.isdir(run_dir) and not args.dry_run:
     shutil.rmtree(run_dir)
 os.makedirs(run_dir, exist_ok=True)
 
-sources = {}
+# Each stage is skipped when its inputs didn't change since it last ran
+manifest = Manifest(run_dir, dry_run=args.dry_run, fresh=args.rerun)
 
-for s in config['sources']:
+sources = {}
+fetched = []
+fetch_pending = []
+fetch_parallelism = config.get('fetch_parallelism', 4)
+progress = MultiProgress(len(config['sources']))
+
+class FetchError(Exception):
+    pass
+
+# Set when a source fails, to stop the other downloads and back-translations
+fetch_cancelled = threading.Event()
+
+def fetch_progress(label):
+    update = progress.callback(label)
+    def callback(p):
+        if fetch_cancelled.is_set():
+            raise FetchError("Cancelled")
+        update(p)
+    return callback
+
+def source_label(s):
+    if isinstance(s, dict):
+        s = s.get("source", "")
+    return os.path.basename(s.rstrip("/"))
+
+# Back-translations run one at a time, since each keeps all cores busy
+backtranslate_lock = threading.Lock()
+
+def backtranslated_source(model, target, s):
+    """Synthetic source side for the monolingual target text of source s, translated
+    with a reverse model. Cached by model and file, and resumed if interrupted.
+    None in dry runs if it still needs to be generated"""
+    if not os.path.isfile(model):
+        raise FetchError(f"Cannot find back-translation model {model}. Exiting...")
+    with zipfile.ZipFile(model, 'r') as zip_ref:
+        metadata = json.loads(zip_ref.read([n for n in zip_ref.namelist() if os.path.basename(n) == "metadata.json"][0]))
+    if metadata['from_code'] != config['to']['code'] or metadata['to_code'] != config['from']['code']:
+        raise FetchError(f"{model} translates {metadata['from_code']} --> {metadata['to_code']}, but back-translation needs {config['to']['code']} --> {config['from']['code']}. Exiting...")
+
+    beam_size = config.get('backtranslate_beam_size', 1)
+    key = hashlib.md5(json.dumps([fingerprint(model), fingerprint(target), beam_size]).encode('utf-8')).hexdigest()
+    source = os.path.join(cache_dir, "backtranslate", key, "source.txt")
+    if os.path.isfile(source):
+        return source
+
+    manifest.report("backtranslate", True, s)
+    if args.dry_run:
+        return None
+
+    os.makedirs(os.path.dirname(source), exist_ok=True)
+    cmd = [sys.executable, os.path.join(current_dir, "batch_translate.py"),
+           "--model", model,
+           "--input", target,
+           "--output", source,
+           "--beam-size", str(beam_size),
+           "--max-batch-size", str(config.get('backtranslate_batch_size', 32))]
+    if config.get('backtranslate_processes') is not None:
+        cmd += ["--processes", str(config['backtranslate_processes'])]
+    with backtranslate_lock:
+        if fetch_cancelled.is_set():
+            raise FetchError("Cancelled")
+        proc = subprocess.Popen(cmd)
+        while proc.poll() is None:
+            if fetch_cancelled.wait(0.5):
+                proc.terminate()
+                proc.wait()
+                raise FetchError("Cancelled")
+        if proc.returncode != 0:
+            raise FetchError("Back-translation failed. Run train.py again to resume. Exiting...")
+    return source
+
+def fetch_source(s):
+    """Resolve, download and extract a source. Returns {name: source}, empty in dry
+    runs if the source still needs to be downloaded"""
+    result = {}
     filters = []
     transforms = []
     augmenters = []
     weight = None
+    backtranslate = None
+    extract = config.get('extract', True)
 
     if isinstance(s, dict):
         if not "source" in s:
@@ -96,31 +191,62 @@ for s in config['sources']:
         transforms = s.get('transforms', [])
         augmenters = s.get('augmenters', [])
         weight = s.get("weight")
+        extract = s.get("extract", extract)
+        backtranslate = s.get("backtranslate")
         s = s["source"]
 
+    # Weighted sources are read by OpenNMT and back-translated ones
+    # by batch_translate.py, which need plain files
+    if weight is not None or backtranslate is not None:
+        extract = True
+
+    label = source_label(s)
     md5 = hashlib.md5(s.encode('utf-8')).hexdigest()
     
     def add_source_from(dir):
+        add_source_from_files([f.path for f in os.scandir(dir) if f.is_file()], dir)
+
+    def add_source_from_archive(zip_path):
+        # Read source/target straight out of the archive
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            files = [member_path(zip_path, info.filename) for info, name in archives.targets(zip_ref) if not "/" in name]
+        add_source_from_files(files, zip_path)
+
+    def add_source_from_files(files, dir):
         source, target = None, None
         skip_reverse = False
-        for f in [f.path for f in os.scandir(dir) if f.is_file()]:
-            if "target" in f.lower():
+        for f in files:
+            # Compressed files (.gz, .xz, .zst, .bz2) are decompressed on the fly
+            name = strip_compression(os.path.basename(f)).lower()
+            if "target" in name:
                 target = f
-            elif f.lower().endswith(f".{config['to']['code']}"):
+            elif name.endswith(f".{config['to']['code']}"):
                 target = f
                 skip_reverse = True
             
-            if "source" in f.lower():
+            if "source" in name:
                 source = f
-            elif f.lower().endswith(f".{config['from']['code']}"):
+            elif name.endswith(f".{config['from']['code']}"):
                 source = f
                 skip_reverse = True
 
 
+        if backtranslate is not None and target is not None:
+            if args.reverse:
+                raise FetchError(f"Back-translated sources cannot be reversed: {s} ({dir}). Exiting...")
+            if is_compressed(target):
+                raise FetchError(f"Back-translated sources are read by batch_translate.py and cannot be compressed: {s} ({dir}). Exiting...")
+            source = backtranslated_source(backtranslate, target, s)
+            if source is None:
+                fetch_pending.append(s)
+                return
+
         if source is not None and target is not None:
             if args.reverse and not skip_reverse:
                 source, target = target, source
-            sources[s] = {
+            if weight is not None and (is_compressed(source) or is_compressed(target)):
+                raise FetchError(f"Weighted sources are read directly by OpenNMT and cannot be compressed: {s} ({dir}). Exiting...")
+            result[s] = {
                 'source': source,
                 'target': target,
                 'hash': md5,
@@ -130,8 +256,7 @@ for s in config['sources']:
                 'weight': weight,
             }
         else:
-            print(f"Cannot find a source.txt and a target.txt in {s} ({dir}). Exiting...")
-            exit(1)
+            raise FetchError(f"Cannot find a source.txt and a target.txt in {s} ({dir}). Exiting...")
 
     if s.lower().startswith("file://"):
         add_source_from(s[7:])
@@ -140,62 +265,128 @@ for s in config['sources']:
             try:
                 s = get_opus_dataset_url(s[7:], config["from"]["code"], config["to"]["code"], run_dir)
             except Exception as e:
-                print(e)
-                exit(1)
+                raise FetchError(str(e))
 
         # Network/OPUS URL
         dataset_path = os.path.join(cache_dir, md5)
         zip_path = dataset_path + ".zip"
 
-        # Download first?
-        if not os.path.isdir(dataset_path):
-            def download_source():
-                def print_progress(progress):
-                    print(f"\r{s} [{int(progress)}%]     ", end='\r')
-                
-                download(s, cache_dir, progress_callback=print_progress, basename=os.path.basename(zip_path))
-                print()
+        # Old caches only have the extracted files
+        if os.path.isdir(dataset_path) and not os.path.isfile(zip_path):
+            add_source_from(dataset_path)
+            return result
+
+        if extract and os.path.isdir(dataset_path) and archives.is_extracted(zip_path, dataset_path):
+            add_source_from(dataset_path)
+            return result
+
+        fetched.append(s)
+        manifest.report("fetch", True, s)
+        if args.dry_run:
+            fetch_pending.append(s)
+            return result
+
+        # Download first? Connections are shared among concurrent downloads
+        def download_source():
+            download(s, cache_dir, progress_callback=fetch_progress(label), basename=os.path.basename(zip_path),
+                     parallel_downloads=max(1, 16 // fetch_parallelism))
 
-            if not os.path.isfile(zip_path):
+        if not os.path.isfile(zip_path):
+            download_source()
+        else:
+            # Quick check
+            try:
+                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                    pass
+            except:
+                print(f"Corrupted .zip file, redownloading {zip_path}")
+                os.unlink(zip_path)
                 download_source()
-            else:
-                # Quick check
-                try:
-                    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                        pass
-                except:
-                    print(f"Corrupted .zip file, redownloading {zip_path}")
-                    os.unlink(zip_path)
-                    download_source()
-
-            os.makedirs(dataset_path, exist_ok=True)
+
+        if extract:
+            # The .zip is kept to validate the extracted files on the next run
             print(f"Extracting {zip_path} to {dataset_path}")
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(dataset_path)
-            
-            os.unlink(zip_path)
-        
-            subfolders = [ f.path for f in os.scandir(dataset_path) if f.is_dir()]
-            if len(subfolders) == 1:
-                # Move files from subfolder
-                for f in [f.path for f in os.scandir(subfolders[0]) if f.is_file()]:
-                    shutil.move(f, dataset_path)
-                
-                shutil.rmtree(subfolders[0])
-        
-        add_source_from(dataset_path)
+            archives.extract(zip_path, dataset_path)
+            add_source_from(dataset_path)
+        else:
+            add_source_from_archive(zip_path)
+
+    return result
+
+def configure_source(k, source):
+    if source['weight'] is not None:
+        # Weighted sources only use their own filters and transforms,
+        # applied by OpenNMT's data loader while training
+        if len(source['augmenters']) > 0:
+            raise FetchError(f"Augmenters cannot be used with weighted sources: {k}. Exiting...")
+        for f in get_funcs(filter_funcs, source['filters']):
+            if f.__name__ in ["top", "excerpt"] or getattr(f, "stateful", False):
+                raise FetchError(f"The {f.__name__} filter cannot be used with weighted sources: {k}. Exiting...")
+        get_funcs(transform_funcs, source['transforms'])
+        if len(source['filters']) > 0 or len(source['transforms']) > 0:
+            lazy_corpora[k] = {'filters': source['filters'], 'transforms': source['transforms']}
+    else:
+        if config.get('filters'):
+            for f in reversed(config['filters']):
+                source['filters'].insert(0, f)
+        if config.get('transforms'):
+            for t in reversed(config['transforms']):
+                source['transforms'].insert(0, t)
+        if config.get('augmenters'):
+            for a in reversed(config['augmenters']):
+                source['augmenters'].insert(0, a)
+
+merge_processes = config.get('merge_processes')
+merge_buffer_size = config.get('merge_buffer_size', 256) * 1024 * 1024
+merge_adaptive_filters = config.get('merge_adaptive_filters', False)
+
+# Sources are fetched concurrently. The ones that are ready are filtered
+# into the merge cache while the others are still downloading.
+# With merge_processes, workers are forked, which isn't safe while other threads
+# hold locks, so sources are only processed by merge_shuffle once all are fetched
+lazy_corpora = {}
+results = [None] * len(config['sources'])
+prepare_early = not args.dry_run and (merge_processes is None or merge_processes <= 1)
+fetcher = ThreadPoolExecutor(max_workers=fetch_parallelism)
+preparer = ThreadPoolExecutor(max_workers=1)
+try:
+    futures = {fetcher.submit(fetch_source, s): i for i, s in enumerate(config['sources'])}
+    prepared = []
+    for future in as_completed(futures):
+        i = futures[future]
+        results[i] = future.result()
+        progress.finish(source_label(config['sources'][i]))
+
+        for k, source in results[i].items():
+            configure_source(k, source)
+            if prepare_early:
+                prepared.append(preparer.submit(prepare_source, k, source, run_dir,
+                                                max_buffer_size=merge_buffer_size,
+                                                adaptive_filters=merge_adaptive_filters))
+    for p in prepared:
+        p.result()
+except BaseException as e:
+    # Stop the other fetches, instead of waiting for them to complete
+    fetch_cancelled.set()
+    fetcher.shutdown(wait=False, cancel_futures=True)
+    preparer.shutdown(wait=False, cancel_futures=True)
+    if isinstance(e, FetchError):
+        print()
+        print(e)
+        exit(1)
+    raise
+fetcher.shutdown()
+preparer.shutdown()
+
+# Keep the order of the config
+for result in results:
+    sources.update(result)
+lazy_corpora = {k: lazy_corpora[k] for k in sources if k in lazy_corpora}
+
+if len(fetched) == 0:
+    manifest.report("fetch", False)
 
 for k in sources:
-    if config.get('filters'):
-        for f in reversed(config['filters']):
-            sources[k]['filters'].insert(0, f)
-    if config.get('transforms'):
-        for t in reversed(config['transforms']):
-            sources[k]['transforms'].insert(0, t)
-    if config.get('augmenters'):
-        for a in reversed(config['augmenters']):
-            sources[k]['augmenters'].insert(0, a)
-
     print(f" - {k} (hash:{sources[k]['hash'][:7]})")
 
 stanza_lang_code = config['from']['code']
@@ -221,7 +412,8 @@ if stanza_lang_code in stanza_remap:
 
 
 if not os.path.isdir(os.path.join(stanza_dir, stanza_lang_code)):
-    while True:
+    manifest.report("fetch", True, "stanza model")
+    while not args.dry_run:
         try:
             os.makedirs(stanza_dir, exist_ok=True)
             stanza.download(stanza_lang_code, model_dir=stanza_dir, processors="tokenize")
@@ -230,7 +422,7 @@ if not os.path.isdir(os.path.join(stanza_dir, stanza_lang_code)):
             print(f'Cannot download stanza model: {str(e)}')
             exit(1)
 
-if remapped:
+if remapped and not args.dry_run:
     resources_file = os.path.join(stanza_dir, "resources.json")
     with open(resources_file, "r", encoding="utf-8") as f:
         resources = json.loads(f.read())
@@ -244,34 +436,114 @@ if remapped:
         print("Warn: lang code already in stanza model")
 
 all_weighted = sum([1 for k in sources if sources[k]['weight'] is not None]) == len(sources)
-if all_weighted:
-    extract_flores_val(config['from']['code'], config['to']['code'], run_dir, dataset="devtest")
-changed = merge_shuffle(sources, run_dir)
-has_merged = os.path.isfile(os.path.join(rel_run_dir, 'src-train.txt'))
 
+# Merge
+merge_seed = config.get('merge_seed', 0)
+merge_stratified_validation = config.get('merge_stratified_validation', False)
+merge_hash = None if fetch_pending else merge_key(sources, seed=merge_seed, stratified_validation=merge_stratified_validation)
+if manifest.should_run("merge", merge_hash):
+    manifest.start("merge", merge_hash)
+    if all_weighted:
+        extract_flores_val(config['from']['code'], config['to']['code'], run_dir, dataset="devtest")
+    merged = merge_shuffle(sources, run_dir,
+                  processes=merge_processes,
+                  max_buffer_size=merge_buffer_size,
+                  max_dedup_memory=config.get('merge_dedup_memory', 1024) * 1024 * 1024,
+                  max_shuffle_memory=config.get('merge_shuffle_memory', 1024) * 1024 * 1024,
+                  seed=merge_seed,
+                  stratified_validation=merge_stratified_validation,
+                  adaptive_filters=merge_adaptive_filters)
+    if merged is not None:
+        merge_outputs = ["src-train.txt", "tgt-train.txt", "src-val.txt", "tgt-val.txt"]
+    elif all_weighted:
+        merge_outputs = ["src-val.txt", "tgt-val.txt"]
+    else:
+        # Every line of the merged sources was filtered out
+        merge_outputs = []
+    merge_outputs = [os.path.join(run_dir, f) for f in merge_outputs]
+    missing = [f for f in merge_outputs if not os.path.isfile(f)]
+    if len(missing) > 0:
+        raise Exception(f"The merge did not write {', '.join(missing)}")
+    manifest.done("merge", merge_hash, merge_outputs)
+
+# In dry runs, the merge may not have run yet
+has_merged = not all_weighted and (args.dry_run or os.path.isfile(os.path.join(run_dir, "src-train.txt")))
+
+# Distillation: the target side of the merged corpus is replaced with its translation by a teacher model
+train_src_file = os.path.join(run_dir, "src-train.txt")
+train_tgt_file = os.path.join(run_dir, "tgt-train.txt")
+corpus_key = merge_hash
+teacher = config.get('teacher')
+if teacher is not None:
+    if not has_merged:
+        print("Distillation needs sources without a weight. Exiting...")
+        exit(1)
+    if not os.path.isfile(teacher):
+        print(f"Cannot find teacher model {teacher}. Exiting...")
+        exit(1)
+    distill_beam_size = config.get('distill_beam_size', 4)
+    corpus_key = stage_key([merge_hash], teacher=fingerprint(teacher), beam_size=distill_beam_size)
+    train_tgt_file = os.path.join(run_dir, "tgt-train.distilled.txt")
+    if manifest.should_run("distill", corpus_key):
+        manifest.start("distill", corpus_key)
+        # In a separate process, since its workers are spawned and would run train.py again
+        cmd = [sys.executable, os.path.join(current_dir, "batch_translate.py"),
+               "--model", teacher,
+               "--input", train_src_file,
+               "--output", train_tgt_file,
+               "--beam-size", str(distill_beam_size),
+               "--max-batch-size", str(config.get('distill_batch_size', 32))]
+        if config.get('distill_processes') is not None:
+            cmd += ["--processes", str(config['distill_processes'])]
+        if subprocess.run(cmd).returncode != 0:
+            print("Distillation failed. Run train.py again to resume. Exiting...")
+            exit(1)
+        manifest.done("distill", corpus_key, [train_tgt_file])
+
+# SentencePiece
 sp_model_path = os.path.join(run_dir, "sentencepiece.model")
-if not os.path.isfile(sp_model_path) or changed:
+sp_vocab_file = os.path.join(run_dir, "sentencepiece.vocab")
+input_sentence_size = config.get('input_sentence_size', 1000000)
+spm_key = stage_key([corpus_key],
+                    vocab_size=config.get('vocab_size', 50000),
+                    character_coverage=config.get('character_coverage', 1.0),
+                    input_sentence_size=input_sentence_size,
+                    seed=merge_seed)
+if manifest.should_run("spm", spm_key):
+    manifest.start("spm", spm_key)
+
+    # Same proportions as the corpora seen during training
+    vocab_corpora = []
+    if has_merged:
+        vocab_corpora.append((train_src_file, train_tgt_file, 1))
+    for k in sources:
+        if sources[k]['weight'] is not None:
+            vocab_corpora.append((sources[k]['source'], sources[k]['target'], sources[k]['weight']))
+
+    # Sample the input instead of letting SentencePiece load whole corpora
+    sp_input = os.path.join(run_dir, "sentencepiece-input.txt")
+    print("Sampling sentencepiece input")
+    start = time.time()
+    sampled = write_vocab_sample(vocab_corpora, sp_input, input_sentence_size, seed=merge_seed,
+                                 index_dir=os.path.join(cache_dir, "index"))
+    print(f"Sampled {sampled} sentences ({time.time() - start:.2f}s)")
+
+    vocab_size = config.get('vocab_size', 50000)
     while True:
         try:
-            datasets = []
-            if has_merged:
-                datasets += [os.path.join(run_dir, "src-train.txt"), os.path.join(run_dir, "tgt-train.txt")]
-            for k in sources:
-                if sources[k]['weight'] is not None:
-                    datasets += [sources[k]['source'], sources[k]['target']]
-
-            spm.SentencePieceTrainer.train(input=datasets, 
-                                            model_prefix=f"{run_dir}/sentencepiece", vocab_size=config.get('vocab_size', 50000),
+            spm.SentencePieceTrainer.train(input=sp_input, 
+                                            model_prefix=f"{run_dir}/sentencepiece", vocab_size=vocab_size,
                                             character_coverage=config.get('character_coverage', 1.0),
-                                            input_sentence_size=config.get('input_sentence_size', 1000000),
-                                            shuffle_input_sentence=True)
+                                            input_sentence_size=input_sentence_size,
+                                            shuffle_input_sentence=True,
+                                            num_threads=os.cpu_count())
             break
         except Exception as e:
             err = str(e)
             if "Vocabulary size too high" in err:
                 matches = re.match(r".*Please set it to a value <= (\d+)", err)
                 if matches is not None:
-                    config["vocab_size"] = int(matches.group(1))
+                    vocab_size = int(matches.group(1))
                     print(f"WARNING: vocabulary size too high, reducing to {matches.group(1)}")
                 else:
                     print(err)
@@ -280,7 +552,31 @@ if not os.path.isfile(sp_model_path) or changed:
                 print(err)
                 exit(1)
 
-os.makedirs(onmt_dir, exist_ok=True)
+    os.unlink(sp_input)
+    manifest.done("spm", spm_key, [sp_model_path, sp_vocab_file])
+
+# The vocabulary might have been reduced
+if os.path.isfile(sp_vocab_file):
+    with open(sp_vocab_file, "r", encoding="utf-8") as f:
+        config["vocab_size"] = min(config.get('vocab_size', 50000), sum(1 for _ in f))
+
+# Encode the training corpus once instead of at every epoch
+pretokenized = has_merged and config.get('pretokenize', False)
+pretokenize_key = None
+if pretokenized:
+    src_seq_length = config.get('src_seq_length', 150)
+    tgt_seq_length = config.get('tgt_seq_length', 150)
+    pretokenize_key = stage_key([corpus_key, spm_key], src_seq_length=src_seq_length, tgt_seq_length=tgt_seq_length)
+    if manifest.should_run("pretokenize", pretokenize_key):
+        manifest.start("pretokenize", pretokenize_key)
+        tok_files = [os.path.join(run_dir, "src-train.tok"), os.path.join(run_dir, "tgt-train.tok")]
+        start = time.time()
+        kept, dropped = pretokenize(sp_model_path, train_src_file, train_tgt_file,
+                                    tok_files[0], tok_files[1],
+                                    src_seq_length=src_seq_length, tgt_seq_length=tgt_seq_length,
+                                    num_threads=config.get('pretokenize_threads'))
+        print(f"Kept {kept} sentences, removed {dropped} empty or too long sentences ({time.time() - start:.2f}s)")
+        manifest.done("pretokenize", pretokenize_key, tok_files)
 
 transforms = ['sentencepiece', 'filtertoolong']
 corpora = {
@@ -290,10 +586,17 @@ corpora = {
         'transforms': ['sentencepiece']
     }
 }
-if has_merged:
+if pretokenized:
+    corpora['corpus_1'] = {
+        'path_src': f'{rel_run_dir}/src-train.tok',
+        'path_tgt': f'{rel_run_dir}/tgt-train.tok',
+        'transforms': [],
+        'weight': 1
+    }
+elif has_merged:
     corpora['corpus_1'] = {
-        'path_src': f'{rel_run_dir}/src-train.txt',
-        'path_tgt': f'{rel_run_dir}/tgt-train.txt',
+        'path_src': f'{rel_run_dir}/{os.path.basename(train_src_file)}',
+        'path_tgt': f'{rel_run_dir}/{os.path.basename(train_tgt_file)}',
         'transforms': transforms,
         'weight': 1
     }
@@ -304,7 +607,7 @@ for k in sources:
             'path_src': sources[k]['source'],
             'path_tgt': sources[k]['target'],
             'weight': sources[k]['weight'],
-            'transforms': transforms,            
+            'transforms': (['locomotive'] if k in lazy_corpora else []) + transforms,
         }
 
 onmt_config = {
@@ -382,6 +685,28 @@ onmt_config = {
     'self_attn_type': 'scaled-dot'
 }
 
+# Architecture presets, which config defined values can still override
+presets = {
+    # Smaller and faster to run on CPU, meant to be distilled from a teacher model
+    'student': {
+        'enc_layers': 6,
+        'dec_layers': 2,
+        'heads': 4,
+        'hidden_size': 256,
+        'rnn_size': 256,
+        'word_vec_size': 256,
+        'transformer_ff': 1024,
+    },
+}
+if config.get('preset') is not None:
+    if config['preset'] not in presets:
+        print(f"Invalid preset: {config['preset']} (must be one of {', '.join(presets)}). Exiting...")
+        exit(1)
+    onmt_config.update(presets[config['preset']])
+
+if len(lazy_corpora) > 0:
+    onmt_config['locomotive_config'] = f'{rel_run_dir}/locomotive.json'
+
 no_gpu = ctranslate2.get_cuda_device_count() == 0
 if sys.platform == 'darwin' or no_gpu:
     # CPU
@@ -402,32 +727,62 @@ for k in onmt_config:
         onmt_config[k] = config[k]
 
 onmt_config_path = os.path.join(run_dir, "config.yml")
-with open(onmt_config_path, "w", encoding="utf-8") as f:
-    f.write(yaml.dump(onmt_config))
-    print(f"Wrote {onmt_config_path}")
-
-sp_vocab_file = os.path.join(run_dir, "sentencepiece.vocab")
+if not args.dry_run:
+    os.makedirs(onmt_dir, exist_ok=True)
+    if len(lazy_corpora) > 0:
+        with open(os.path.join(run_dir, "locomotive.json"), "w", encoding="utf-8") as f:
+            f.write(json.dumps(lazy_corpora, indent=4))
+    with open(onmt_config_path, "w", encoding="utf-8") as f:
+        f.write(yaml.dump(onmt_config))
+        print(f"Wrote {onmt_config_path}")
+
+# Vocabulary
 onmt_vocab_file = os.path.join(onmt_dir, "openmt.vocab")
-if changed and os.path.isfile(onmt_vocab_file):
-    os.unlink(onmt_vocab_file)
-    
-if not os.path.isfile(onmt_vocab_file):
+vocab_key = stage_key([spm_key])
+if manifest.should_run("vocab", vocab_key):
     #subprocess.run(["onmt_build_vocab", "-config", onmt_config_path, "-n_sample", "-1", "-num_threads", str(os.cpu_count())])
     sp_vocab_to_onmt_vocab(sp_vocab_file, onmt_vocab_file)
+    manifest.done("vocab", vocab_key, [onmt_vocab_file])
+
+# Training
+# Options that change how long or where the model is trained, but not the model itself
+run_options = ['save_data', 'save_model', 'save_checkpoint_steps', 'keep_checkpoint', 'valid_steps', 'train_steps',
+               'early_stopping', 'num_worker', 'world_size', 'gpu_ranks', 'queue_size', 'bucket_size',
+               'valid_batch_size', 'locomotive_config']
+model_key = stage_key([corpus_key, vocab_key] + ([pretokenize_key] if pretokenized else []),
+                      onmt={k: v for k, v in onmt_config.items() if k not in run_options},
+                      locomotive=lazy_corpora)
+train_key = stage_key([model_key], train_steps=onmt_config['train_steps'])
 
-last_checkpoint = os.path.join(onmt_dir, os.path.basename(onmt_config["save_model"]) + f'_step_{onmt_config["train_steps"]}.pt')
 def get_checkpoints():
     chkpts = [cp for cp in glob.glob(os.path.join(onmt_dir, "*.pt")) if "averaged.pt" not in cp]
-    return list(sorted(chkpts, key=lambda x: int(re.findall(r'\d+', x)[0])))
-
-if (not (os.path.isfile(last_checkpoint) or args.inflight)) or changed or args.rerun_onmt:
-    cmd = ["onmt_train", "-config", onmt_config_path]
+    return list(sorted(chkpts, key=lambda x: int(re.findall(r'\d+', os.path.basename(x))[-1])))
+
+if args.inflight:
+    manifest.report("train", False, "in flight")
+elif manifest.should_run("train", train_key, force=args.rerun_onmt):
+    if len(lazy_corpora) > 0:
+        # onmt_train doesn't know about the locomotive transform
+        cmd = [sys.executable, os.path.join(current_dir, "onmt_tools.py"), "-config", onmt_config_path]
+    else:
+        cmd = ["onmt_train", "-config", onmt_config_path]
 
+    checkpoints = get_checkpoints()
+    previous_model = manifest.previous("train").get('model')
     if args.rerun_onmt:
         delete_checkpoints = glob.glob(os.path.join(onmt_dir, "*.pt"))
         for dc in delete_checkpoints:
             os.unlink(dc)
             print(f"Removed {dc}")
+    elif len(checkpoints) > 0 and previous_model is not None and previous_model != model_key:
+        # Checkpoints of a different model are kept aside rather than resumed
+        previous_dir = os.path.join(onmt_dir, f"previous-{previous_model[:10]}")
+        os.makedirs(previous_dir, exist_ok=True)
+        for cp in checkpoints:
+            shutil.move(cp, previous_dir)
+        print(f"Moved {len(checkpoints)} checkpoints of the previous model to {previous_dir}")
+
+    manifest.start("train", train_key, model=model_key)
 
     if args.tensorboard:
         print("Launching tensorboard")
@@ -451,80 +806,113 @@ if (not (os.path.isfile(last_checkpoint) or args.inflight)) or changed or args.r
     
     # Resume?
     checkpoints = get_checkpoints()
-    if len(checkpoints) > 0 and not changed:
+    if len(checkpoints) > 0:
         print(f"Resuming from {checkpoints[-1]}")
         cmd += ["--train_from", checkpoints[-1]]
 
-    subprocess.run(cmd)
+    if subprocess.run(cmd).returncode == 0:
+        manifest.done("train", train_key, get_checkpoints()[-1:], model=model_key)
 
 # Average
 average_checkpoint = os.path.join(run_dir, "averaged.pt")
 checkpoints = get_checkpoints()
 print(f"Total checkpoints: {len(checkpoints)}")
 
-if len(checkpoints) == 0:
+if len(checkpoints) == 0 and not args.dry_run:
     print("Something went wrong, looks like onmt_train failed?")
     exit(1)
 
-if os.path.isfile(average_checkpoint):
-    os.unlink(average_checkpoint)
-
-if len(checkpoints) == 1 or args.inflight:
-    print("Single checkpoint")
-    average_checkpoint = checkpoints[-1]
+if len(checkpoints) <= 1 or args.inflight or config.get('avg_checkpoints', 1) == 1:
+    average_checkpoints = checkpoints[-1:]
 else:
-    if config.get('avg_checkpoints', 1) == 1:
-        print("No need to average 1 model")
-        average_checkpoint = checkpoints[-1]
-    else:
-        avg_num = min(config.get('avg_checkpoints', 1), len(checkpoints))
-        print(f"Averaging {avg_num} models")
-        average_models(checkpoints[-avg_num:], average_checkpoint)
+    average_checkpoints = checkpoints[-min(config.get('avg_checkpoints', 1), len(checkpoints)):]
+average_key = stage_key([manifest.output_key("train", train_key)],
+                        checkpoints=[(os.path.basename(cp), os.path.getsize(cp)) for cp in average_checkpoints])
+
+if average_key is None:
+    # Dry run: the checkpoints are only known once training ran
+    manifest.should_run("average", average_key)
+elif len(average_checkpoints) == 1:
+    manifest.report("average", False, "single checkpoint")
+    average_checkpoint = average_checkpoints[0]
+elif manifest.should_run("average", average_key):
+    print(f"Averaging {len(average_checkpoints)} models")
+    average_models(average_checkpoints, average_checkpoint)
+    manifest.done("average", average_key, [average_checkpoint])
+
 # Quantize
 ct2_model_dir = os.path.join(run_dir, "model")
-if os.path.isdir(ct2_model_dir):
-    shutil.rmtree(ct2_model_dir)
-
-print("Converting to ctranslate2")
-subprocess.run([
-        "ct2-opennmt-py-converter",
-        "--model_path",
-        average_checkpoint,
-        "--output_dir",
-        ct2_model_dir,
-        "--quantization",
-        "int8"])
+quantization = config.get('quantization', "int8")
+if isinstance(quantization, list) and len(quantization) > 1:
+    # Sweep: benchmark each quantization and keep the fastest within tolerance
+    quantization_tolerance = config.get('quantization_tolerance', 1.0)
+    benchmark_sentences = config.get('benchmark_sentences', 500)
+    convert_key = stage_key([average_key], quantization=quantization, tolerance=quantization_tolerance, sentences=benchmark_sentences)
+else:
+    if isinstance(quantization, list):
+        quantization = quantization[0]
+    convert_key = stage_key([average_key], quantization=quantization)
+
+def convert_model(output_dir, quantization):
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    ctranslate2.converters.OpenNMTPyConverter(average_checkpoint).convert(output_dir, quantization=quantization, force=True)
+
+if manifest.should_run("convert", convert_key):
+    if isinstance(quantization, list):
+        with open(os.path.join(run_dir, "src-val.txt"), "r", encoding="utf-8") as f:
+            src_val = [l.rstrip("\n") for l in itertools.islice(f, benchmark_sentences)]
+        with open(os.path.join(run_dir, "tgt-val.txt"), "r", encoding="utf-8") as f:
+            tgt_val = [l.rstrip("\n") for l in itertools.islice(f, benchmark_sentences)]
+        best, report = quantization_sweep(convert_model, ct2_model_dir, quantization, SentencePieceTokenizer(sp_model_path),
+                                          src_val, tgt_val, tolerance=quantization_tolerance)
+        with open(os.path.join(run_dir, "quantization-report.json"), "w", encoding="utf-8") as f:
+            f.write(json.dumps({'quantization': best, 'variants': report}, indent=4))
+    else:
+        print(f"Converting to ctranslate2 using {quantization}")
+        convert_model(ct2_model_dir, quantization)
+    manifest.done("convert", convert_key, [os.path.join(ct2_model_dir, "model.bin")])
+
+# Vocabulary map, to restrict the output vocabulary at decoding time (use_vmap)
+package_upstream = [convert_key, spm_key]
+vmap_file = os.path.join(ct2_model_dir, "vmap.txt")
+if config.get('vmap', False):
+    vmap_settings = {
+        'max_sentences': config.get('vmap_sentences', 1000000),
+        'fixed_size': config.get('vmap_fixed', 500),
+        'max_targets': config.get('vmap_targets', 50),
+    }
+    vmap_key = stage_key([convert_key, corpus_key, spm_key], **vmap_settings)
+    package_upstream.append(vmap_key)
+    if manifest.should_run("vmap", vmap_key):
+        sp = spm.SentencePieceProcessor(model_file=sp_model_path)
+        num_threads = os.cpu_count() or 1
+        mapped = build_vmap(lambda lines: sp.encode(lines, out_type=str, num_threads=num_threads),
+                            train_src_file, train_tgt_file,
+                            vmap_file, **vmap_settings)
+        print(f"Wrote {vmap_file} ({mapped} source tokens)")
+        manifest.done("vmap", vmap_key, [vmap_file])
+elif os.path.isfile(vmap_file) and not args.dry_run:
+    os.unlink(vmap_file)
 
 # Create .argosmodel package
 package_slug = f"translate-{config['from']['code']}_{config['to']['code']}-{config['version'].replace('.', '_')}"
 package_file = os.path.join(run_dir, f"{package_slug}.argosmodel")
-if os.path.isfile(package_file):
-    os.unlink(package_file)
-package_folder = os.path.join(run_dir, package_slug)
-if os.path.isdir(package_folder):
-    shutil.rmtree(package_folder)
-os.makedirs(package_folder, exist_ok=True)
-
-readme_file = os.path.join(package_folder, "README.md")
-with open(readme_file, "w", encoding="utf-8") as f:
-    f.write(readme)
-metadata_file = os.path.join(package_folder, "metadata.json")
-with open(metadata_file, "w", encoding="utf-8") as f:
-    f.write(json.dumps(metadata))
-
-shutil.copy(sp_model_path, package_folder)
-shutil.copytree(ct2_model_dir, os.path.join(package_folder, "model"))
-shutil.copytree(stanza_dir, os.path.join(package_folder, "stanza"))
-
-print(f"Writing {package_file}")
-zip_filename = os.path.join(run_dir, f"{package_slug}.zip")
-def zipdir(path, ziph):
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            ziph.write(os.path.join(root, file),
-                       os.path.relpath(os.path.join(root, file),
-                                       os.path.join(path, '..')))
-with zipfile.ZipFile(zip_filename, 'w') as zipf:
-    zipdir(package_folder, zipf)
-os.rename(zip_filename, package_file)
-print("Done!")
+package_compression = config.get('package_compression', 0)
+package_key = stage_key(package_upstream, metadata=metadata, readme=readme, stanza=stanza_lang_code, compression=package_compression)
+if manifest.should_run("package", package_key):
+    # Files are streamed into the package from where they are
+    print(f"Writing {package_file}")
+    write_package(package_file,
+                  [(os.path.join(package_slug, "sentencepiece.model"), sp_model_path)] +
+                  folder_members(ct2_model_dir, os.path.join(package_slug, "model")) +
+                  folder_members(stanza_dir, os.path.join(package_slug, "stanza")),
+                  contents={os.path.join(package_slug, "README.md"): readme,
+                            os.path.join(package_slug, "metadata.json"): json.dumps(metadata)},
+                  compresslevel=package_compression)
+    manifest.done("package", package_key, [package_file])
+
+if args.dry_run:
+    manifest.summary()
+else:
+    print("Done!")
@@ -0,0 +1,102 @@
+import os
+import itertools
+import numpy as np
+
+# Co-occurring (source, target) token ids are packed into a single int64
+ID_BITS = 32
+
+def _ids(tokens, vocab):
+    return np.array(sorted(set(vocab.setdefault(t, len(vocab)) for t in tokens)), dtype=np.int64)
+
+def _merge(keys, counts, pending):
+    keys = np.concatenate([keys] + [k for k, c in pending])
+    counts = np.concatenate([counts] + [c for k, c in pending])
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=counts).astype(np.int64)
+
+def _grow(counts, size):
+    return np.concatenate([counts, np.zeros(size - len(counts), dtype=np.int64)]) if size > len(counts) else counts
+
+def build_vmap(encode, src_file, tgt_file, out_file, max_sentences=1000000, fixed_size=500, max_targets=50,
+               min_prob=0.01, max_pairs=50000000, batch_size=10000, encode_tgt=None):
+    """Write a CTranslate2 vocabulary map (vmap.txt, see use_vmap) from the sentence level
+    co-occurrences of source and target tokens in a parallel corpus, read in a single pass.
+    encode(lines) returns the tokens of each line, encode_tgt(lines) those of target lines
+    when the target side has its own vocabulary (default: encode). The fixed_size most frequent target
+    tokens are always candidates. Each source token adds up to max_targets target tokens t
+    for which p(t|s) >= min_prob. When more than max_pairs pairs are counted, rare pairs
+    are dropped. Returns the number of source tokens mapped."""
+    encode_tgt = encode_tgt or encode
+    src_vocab, tgt_vocab = {}, {}
+    src_counts = np.zeros(0, dtype=np.int64)
+    tgt_counts = np.zeros(0, dtype=np.int64)
+    keys = np.zeros(0, dtype=np.int64)
+    counts = np.zeros(0, dtype=np.int64)
+    pending, pending_size = [], 0
+
+    # Lines only end with \n, a \r within a line must not split it
+    with open(src_file, "r", encoding="utf-8", newline="\n") as src_in, \
+         open(tgt_file, "r", encoding="utf-8", newline="\n") as tgt_in:
+        pairs = itertools.islice(zip(src_in, tgt_in), max_sentences)
+        while True:
+            batch = list(itertools.islice(pairs, batch_size))
+            if len(batch) == 0:
+                break
+
+            src_tokens = encode([s.rstrip("\n") for s, t in batch])
+            tgt_tokens = encode_tgt([t.rstrip("\n") for s, t in batch])
+            src_ids = [_ids(s, src_vocab) for s in src_tokens]
+            tgt_ids = [_ids(t, tgt_vocab) for t in tgt_tokens]
+
+            # Number of sentences each token appears in
+            src_counts = _grow(src_counts, len(src_vocab))
+            tgt_counts = _grow(tgt_counts, len(tgt_vocab))
+            src_counts += np.bincount(np.concatenate(src_ids), minlength=len(src_vocab))
+            tgt_counts += np.bincount(np.concatenate(tgt_ids), minlength=len(tgt_vocab))
+
+            batch_keys = np.concatenate([((s[:, None] << ID_BITS) | t[None, :]).ravel() for s, t in zip(src_ids, tgt_ids)])
+            batch_keys, batch_counts = np.unique(batch_keys, return_counts=True)
+            pending.append((batch_keys, batch_counts))
+            pending_size += len(batch_keys)
+
+            # Merge once there are as many pending pairs as counted ones, so that
+            # the counted pairs are not sorted again for every batch
+            if pending_size >= max(len(keys), max_pairs // 10):
+                keys, counts = _merge(keys, counts, pending)
+                pending, pending_size = [], 0
+                min_count = 1
+                while len(keys) > max_pairs:
+                    keep = counts > min_count
+                    keys, counts = keys[keep], counts[keep]
+                    min_count += 1
+
+    keys, counts = _merge(keys, counts, pending)
+    src_id_to_token = {i: t for t, i in src_vocab.items()}
+    tgt_id_to_token = {i: t for t, i in tgt_vocab.items()}
+
+    fixed = np.argsort(-tgt_counts, kind="stable")[:fixed_size]
+    src = keys >> ID_BITS
+    tgt = keys & ((1 << ID_BITS) - 1)
+    keep = ~np.isin(tgt, fixed) & (counts >= min_prob * src_counts[src])
+    src, tgt, counts = src[keep], tgt[keep], counts[keep]
+
+    # Most frequent targets first, for each source token
+    order = np.lexsort((tgt, -counts, src))
+    src, tgt = src[order], tgt[order]
+    starts = np.searchsorted(src, src, side="left")
+    rank = np.arange(len(src)) - starts
+    keep = rank < max_targets
+    src, tgt = src[keep], tgt[keep]
+
+    mapped = 0
+    with open(out_file + ".tmp", "w", encoding="utf-8", newline="\n") as f:
+        # An empty source token maps to candidates for all inputs
+        f.write("\t" + " ".join(tgt_id_to_token[i] for i in fixed) + "\n")
+        boundaries = np.flatnonzero(np.diff(src)) + 1
+        for s, t in zip(np.split(src, boundaries), np.split(tgt, boundaries)):
+            if len(s) == 0:
+                continue
+            f.write(src_id_to_token[s[0]] + "\t" + " ".join(tgt_id_to_token[i] for i in t) + "\n")
+            mapped += 1
+    os.replace(out_file + ".tmp", out_file)
+    return mapped